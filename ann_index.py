@@ -0,0 +1,197 @@
+#ann_index.py
+import os
+import numpy as np
+
+#Search backends for DB. Rows live in the DB's matrix; a backend only keeps whatever
+#structure it needs to find the nearest of them. All rows and queries are unit length.
+
+#Scale rows to unit length so cosine similarity is a plain dot product
+def normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+#Top-k of each row of a (queries x rows) similarity matrix, best first. Pads with -1 if there are fewer than k rows.
+def top_k(similarities, k):
+    n_queries, n_rows = similarities.shape
+    indices = np.full((n_queries, k), -1, dtype=np.int64)
+    scores = np.full((n_queries, k), -np.inf, dtype=np.float32)
+    if n_rows == 0 or k == 0:
+        return scores, indices
+    kk = min(k, n_rows)
+    part = np.argpartition(-similarities, kk - 1, axis=1)[:, :kk]
+    part_scores = np.take_along_axis(similarities, part, axis=1)
+    order = np.argsort(-part_scores, axis=1)
+    indices[:, :kk] = np.take_along_axis(part, order, axis=1)
+    scores[:, :kk] = np.take_along_axis(part_scores, order, axis=1)
+    return scores, indices
+
+def make_index(settings=None):
+    settings = dict(settings or {})
+    backend = settings.pop('backend', 'exact')
+    match backend:
+        case 'exact':
+            return ExactIndex()
+        case 'ivf':
+            return IVFIndex(**settings)
+        case _:
+            raise ValueError(f"Unknown ANN backend: {backend}")
+
+#Brute force over every row - exact, and the fallback for every other backend
+class ExactIndex:
+    name = 'exact'
+
+    def build(self, vectors):
+        pass
+
+    def add(self, vectors, start):
+        pass
+
+    def search(self, vectors, queries, k):
+        return top_k(queries @ vectors.T, k)
+
+    def save(self, path):
+        pass
+
+    def load(self, path, vectors):
+        return True
+
+    def files(self, path):
+        return []
+
+#Inverted file index - rows are bucketed under the nearest of nlist k-means centroids and a
+#query only scans the nprobe closest buckets. Raise nprobe for recall, lower it for latency.
+class IVFIndex:
+    name = 'ivf'
+
+    def __init__(self, nlist=None, nprobe=8, min_train_rows=10000, train_iterations=10, sample_per_list=64, seed=0):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.min_train_rows = min_train_rows
+        self.train_iterations = train_iterations
+        self.sample_per_list = sample_per_list
+        self.seed = seed
+        self.exact = ExactIndex()
+        self.centroids = None
+        self.assignments = np.zeros(0, dtype=np.int32)
+        #Per-bucket row ids and a contiguous copy of their vectors, so a probe is a slice rather
+        #than a gather, plus a tail of rows appended since the bucket was last packed
+        self.lists = []
+        self.list_vectors = []
+        self.tails = []
+
+    def is_trained(self):
+        return self.centroids is not None
+
+    def build(self, vectors):
+        self.centroids = None
+        self.assignments = np.zeros(0, dtype=np.int32)
+        if len(vectors) < self.min_train_rows:
+            print(f"IVF: {len(vectors)} rows is below min_train_rows, using exact search")
+            return
+        self.train(vectors)
+        self.set_assignments(self.assign(vectors), vectors)
+        print(f"IVF: {len(vectors)} rows in {len(self.centroids)} lists")
+
+    #Spherical k-means on a sample of the rows
+    def train(self, vectors):
+        rng = np.random.default_rng(self.seed)
+        n = len(vectors)
+        nlist = min(self.nlist or max(1, int(np.sqrt(n))), n)
+        sample_size = min(n, nlist * self.sample_per_list)
+        sample = np.asarray(vectors[np.sort(rng.choice(n, size=sample_size, replace=False))], dtype=np.float32)
+        centroids = sample[rng.choice(sample_size, size=nlist, replace=False)].copy()
+        for _ in range(self.train_iterations):
+            assignments = self.assign(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+            counts = np.bincount(assignments, minlength=nlist)
+            #Reseed empty lists from random sample rows
+            empty = np.where(counts == 0)[0]
+            if len(empty) > 0:
+                sums[empty] = sample[rng.choice(sample_size, size=len(empty), replace=False)]
+            centroids = normalize(sums).astype(np.float32)
+        self.centroids = centroids
+
+    def assign(self, vectors, centroids=None, batch=4096):
+        centroids = self.centroids if centroids is None else centroids
+        assignments = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), batch):
+            assignments[start:start + batch] = np.argmax(vectors[start:start + batch] @ centroids.T, axis=1)
+        return assignments
+
+    def set_assignments(self, assignments, vectors):
+        self.assignments = assignments
+        order = np.argsort(assignments, kind='stable')
+        bounds = np.searchsorted(assignments[order], np.arange(len(self.centroids) + 1))
+        self.lists = [order[bounds[i]:bounds[i + 1]] for i in range(len(self.centroids))]
+        self.list_vectors = [np.ascontiguousarray(vectors[ids], dtype=np.float32) for ids in self.lists]
+        self.tails = [[] for _ in range(len(self.centroids))]
+
+    #New rows go straight into their bucket - O(nlist) per row, independent of corpus size
+    def add(self, vectors, start):
+        if not self.is_trained():
+            return
+        new_assignments = self.assign(vectors[start:])
+        self.assignments = np.concatenate([self.assignments, new_assignments])
+        for offset, bucket in enumerate(new_assignments):
+            tail = self.tails[bucket]
+            tail.append(start + offset)
+            #Fold the tail in once it outgrows the packed list - amortized O(1) per row
+            if len(tail) > max(len(self.lists[bucket]), 64):
+                tail = np.array(tail, dtype=np.int64)
+                self.lists[bucket] = np.concatenate([self.lists[bucket], tail])
+                self.list_vectors[bucket] = np.concatenate([self.list_vectors[bucket], vectors[tail]])
+                self.tails[bucket] = []
+
+    def search(self, vectors, queries, k):
+        if not self.is_trained():
+            return self.exact.search(vectors, queries, k)
+        nprobe = min(self.nprobe, len(self.centroids))
+        _, probes = top_k(queries @ self.centroids.T, nprobe)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        for q in range(len(queries)):
+            query = queries[q]
+            candidates = []
+            candidate_scores = []
+            for c in probes[q]:
+                candidates.append(self.lists[c])
+                candidate_scores.append(self.list_vectors[c] @ query)
+                if len(self.tails[c]) > 0:
+                    tail = np.array(self.tails[c], dtype=np.int64)
+                    candidates.append(tail)
+                    candidate_scores.append(vectors[tail] @ query)
+            candidates = np.concatenate(candidates)
+            if len(candidates) == 0:
+                continue
+            q_scores, q_top = top_k(np.concatenate(candidate_scores).reshape(1, -1), k)
+            found = int((q_top[0] >= 0).sum())
+            scores[q, :found] = q_scores[0][:found]
+            indices[q, :found] = candidates[q_top[0][:found]]
+        return scores, indices
+
+    #Persisted next to the snapshot as {path}.ivf.npz
+    def save(self, path):
+        if not self.is_trained():
+            return
+        with open(path + '.ivf.npz.tmp', 'wb') as f:
+            np.savez(f, centroids=self.centroids, assignments=self.assignments, nprobe=self.nprobe)
+        os.replace(path + '.ivf.npz.tmp', path + '.ivf.npz')
+
+    #Rows added after the file was written (e.g. replayed from the WAL) are assigned on load
+    def load(self, path, vectors):
+        if not os.path.exists(path + '.ivf.npz'):
+            return len(vectors) < self.min_train_rows
+        data = np.load(path + '.ivf.npz')
+        self.centroids = data['centroids']
+        assignments = data['assignments']
+        if len(assignments) > len(vectors):
+            return False
+        self.set_assignments(assignments, vectors[:len(assignments)])
+        if len(assignments) < len(vectors):
+            self.add(vectors, len(assignments))
+        return True
+
+    def files(self, path):
+        return [path + '.ivf.npz']
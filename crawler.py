@@ -1,20 +1,67 @@
 #crawler.py
 import re
 import requests
-from bs4 import BeautifulSoup
-from urllib.parse import urljoin, urlparse, urlunparse
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import hashlib
+import random
+import threading
 import time
 
 from document import Document
+import extractor
+
+#Per-host rate limit - allows `burst` requests at once, refilled at `rate` requests per second
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
 
 #Web Crawler 
 class Crawler:
-    def __init__(self, project_name, base_url):
+    def __init__(self, project_name, base_url, project_settings=None):
         self.project_name = project_name
         self.base_url = base_url
+        self.project_settings = project_settings or {}
         self.visited = set()
+        self.visited_lock = threading.Lock()
         self.blocklist = ['https://www.notion.so/help/notion.so/careers', ]
+        #Refresh mode - revisit known pages with conditional requests and only hand back the ones that changed
+        self.refresh = False
+
+        self.concurrency = self.project_settings.get('crawl_concurrency', 8)
+        self.rate = self.project_settings.get('crawl_rate', 1.0)
+        self.burst = self.project_settings.get('crawl_burst', 2)
+        #A zero rate would never refill the buckets, and a burst under one never lets a request through
+        if self.rate <= 0 or self.burst < 1:
+            raise Exception(f"crawl_rate must be above 0 and crawl_burst at least 1 (got {self.rate} and {self.burst})")
+        self.retries = self.project_settings.get('crawl_retries', 3)
+        self.max_backoff = self.project_settings.get('crawl_max_backoff', 60)
+        self.buckets = {}
+        self.buckets_lock = threading.Lock()
+
+        #Keep-alive connections are pooled and reused across requests and threads
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.concurrency, pool_maxsize=self.concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
     #Check Correct Domain 
     def is_valid_url(self, url):
@@ -30,6 +77,9 @@ class Crawler:
         hash_hex = sha256.hexdigest()
         return hash_hex.lower()    
 
+    def content_hash(self, content):
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
     #Visit - download or get get from saved location
     def visit(self, url, document):
         content = document.get_source()
@@ -37,45 +87,97 @@ class Crawler:
             content = self.download(document, url)
         return content
         
-    #Download - get web content
-    def download(self, document, url):
-        retry_counter = 0
-        content = None
-        while content is None and retry_counter < 3:
-            retry_counter += 1
+    def bucket(self, url):
+        host = urlparse(url).netloc
+        with self.buckets_lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.rate, self.burst)
+            return self.buckets[host]
+
+    #Exponential backoff with jitter, or the server's Retry-After when it sends one
+    def backoff(self, attempt, response=None):
+        delay = min(self.max_backoff, 2 ** attempt) * (0.5 + random.random() / 2)
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
             try:
-                response = requests.get(url)
-                time.sleep(1)
-                if response.status_code == 200:
-                    content = response.text
-                else:
-                    print(f"Failed to fetch {url}: Status code {response.status_code}")
-                    print(f"Retry Counter: {retry_counter}")
-              
-            except Exception as e:
-                print(f"Error fetching {url}: {str(e)}")
-        if content is None:
+                delay = float(retry_after)
+            except ValueError:
+                try:
+                    delay = parsedate_to_datetime(retry_after).timestamp() - time.time()
+                except (TypeError, ValueError):
+                    pass
+        return max(0, min(delay, self.max_backoff))
+
+    #Download - get web content. Waits for the host's rate limit and retries 429/5xx and network errors.
+    def download(self, document, url):
+        response = self.fetch(url)
+        if response is None:
             print('Download Failed. Updating Document status to ERROR')
             document.set_status('ERROR')
             raise Exception("Download Failed All Retries")
         else:
+            content = response.text
             document.set_source(content)
+            self.save_validators(document, url, response, content)
             document.set_status('DOWNLOADED')
             return content
 
-    #Parse text for urls - do some cleaning 
-    def extract_links(self, url, html_content):
-        links = []
-        soup = BeautifulSoup(html_content, 'html.parser')
-        for link in soup.find_all('a', href=True):
-            href = link['href']
-            # Remove fragment part
-            parsed_url = urlparse(href)
-            cleaned_url = urlunparse((parsed_url.scheme, parsed_url.netloc, parsed_url.path, parsed_url.params, parsed_url.query, ''))
-            full_url = urljoin(url, cleaned_url)
-            if self.is_valid_url(full_url):
-                links.append(full_url)
-        return links
+    #Conditional re-download of a known page. Returns (content, changed) - a 304 or an identical
+    #body leaves the document untouched; changed content goes back to DOWNLOADED for processing.
+    def revalidate(self, document, url):
+        meta = document.get_meta()
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        response = self.fetch(url, headers)
+        if response is None:
+            print(f"Refresh failed, keeping stored copy: {url}")
+            return document.get_source(), False
+        if response.status_code == 304:
+            print(f"Not modified: {url}")
+            return document.get_source(), False
+
+        content = response.text
+        old_hash = meta.get('content_hash')
+        if old_hash is None and document.get_source() is not None:
+            old_hash = self.content_hash(document.get_source())
+        self.save_validators(document, url, response, content)
+        if self.content_hash(content) == old_hash:
+            print(f"Unchanged: {url}")
+            return content, False
+        print(f"Changed: {url}")
+        document.set_source(content)
+        document.set_status('DOWNLOADED')
+        return content, True
+
+    def save_validators(self, document, url, response, content):
+        document.update_meta(url=url,
+                             etag=response.headers.get('ETag'),
+                             last_modified=response.headers.get('Last-Modified'),
+                             content_hash=self.content_hash(content))
+
+    #GET with rate limiting and retries - returns the response (200 or 304) or None
+    def fetch(self, url, headers=None):
+        retry_counter = 0
+        while retry_counter < self.retries:
+            retry_counter += 1
+            response = None
+            try:
+                self.bucket(url).acquire()
+                response = self.session.get(url, headers=headers, timeout=30)
+                if response.status_code in (200, 304):
+                    return response
+                print(f"Failed to fetch {url}: Status code {response.status_code}")
+                print(f"Retry Counter: {retry_counter}")
+                if response.status_code != 429 and response.status_code < 500:
+                    break
+            except Exception as e:
+                print(f"Error fetching {url}: {str(e)}")
+            if retry_counter < self.retries:
+                time.sleep(self.backoff(retry_counter, response))
+        return None
 
     #Main method - Visit url, Extracts all links and creates new doc_file if one does not exist
     def crawl(self, url):
@@ -83,9 +185,12 @@ class Crawler:
             print(f'URL Out Of Bounds Error: {url}')
             return None, []
         doc_id = self.id_from_url(url)
-        if doc_id in self.visited:
-            print(f'Already visited this session: {url}')
-            return doc_id, []
+        #Claimed before downloading so two workers never fetch the same page
+        with self.visited_lock:
+            if doc_id in self.visited:
+                print(f'Already visited this session: {url}')
+                return doc_id, []
+            self.visited.add(doc_id)
         doc = Document(self.project_name, doc_id)
 
         match doc.status:
@@ -93,14 +198,40 @@ class Crawler:
                 content = self.visit(url, doc)
             case 'ERROR':
                 return doc_id, []
+            case _ if self.refresh:
+                content, changed = self.revalidate(doc, url)
+                if not changed and doc.status == 'PROCESSED':
+                    doc_id = None
             case _:
                 content = doc.get_source()
 
-        self.visited.add(doc_id)
-
-        all_links = self.extract_links(url, content)
+        #One parse gives both the links and the trimmed text, cached on the document for the refiner
+        all_links, trimmed = extractor.extract_document(doc, url)
+        all_links = [link for link in all_links if self.is_valid_url(link)]
         new_links = []
         for link in all_links:
             if self.id_from_url(link) not in self.visited:
                 new_links.append(link)
         return doc_id, new_links
+
+    #Crawl with a pool of workers. next_url() is asked for work whenever a worker is free and returns
+    #None when there is none yet; yields (url, doc_id, new_links, error) as pages finish.
+    def crawl_many(self, next_url):
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            in_flight = {}
+            while True:
+                while len(in_flight) < self.concurrency * 2:
+                    url = next_url()
+                    if url is None:
+                        break
+                    in_flight[pool.submit(self.crawl, url)] = url
+                if len(in_flight) == 0:
+                    return
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    url = in_flight.pop(future)
+                    try:
+                        doc_id, new_links = future.result()
+                        yield url, doc_id, new_links, None
+                    except Exception as e:
+                        yield url, None, [], e
@@ -1,92 +1,96 @@
 #document.py
-import os
 import sys
 import json
 
+from document_store import get_store
+from manifest import get_manifest
+
 ##Setters and getters for data retrieval/persistance
+#Files live in the project's document store (see document_store.py) under doc_id/...
 class Document:
-    def __init__(self, project_name, doc_id, status='UNVISITED'):
+    def __init__(self, project_name, doc_id, status='UNVISITED', store=None):
         self.project_name = project_name
         self.doc_id = doc_id
         self.status = status
+        self.store = store or get_store(project_name)
+        self.manifest = get_manifest(project_name, self.store)
 
-        os.makedirs(os.path.join(self.project_name, 'documents', doc_id), exist_ok=True)
-
-        self.doc_status_filepath = os.path.join(project_name, 'documents', doc_id, 'status.txt')
+        self.doc_status_key = self.key('status.txt')
 
-        if os.path.exists(self.doc_status_filepath):
-            self.status = self.load_file(self.doc_status_filepath)
+        saved_status = self.store.get(self.doc_status_key)
+        if saved_status is not None:
+            self.status = saved_status
         else:
-            self.save_file(self.doc_status_filepath, status, 'txt')
+            self.set_status(status)
         print(self.status)
-            
-    def save_file(self, filepath, content, ftype='txt'):
+
+    #Store key of one of this document's files
+    def key(self, *parts):
+        return '/'.join((self.doc_id,) + parts)
+
+    def encode(self, content, ftype='txt'):
         match ftype:
             case 'json':
-                with open(filepath, 'w') as file:
-                    json.dump(content, file)
-
+                return json.dumps(content)
             case 'txt':
-                with open(filepath, 'w', encoding='utf-8') as file:
-                    file.write(content)
+                return content
+
+    def save_file(self, key, content, ftype='txt'):
+        self.store.put(key, self.encode(content, ftype))
 
-    def load_file(self, filepath, ftype='txt'):
+    def load_file(self, key, ftype='txt'):
+        d = self.store.get(key)
+        if d is None:
+            return None
         match ftype:
             case 'json':
-                with open(filepath, 'r') as file:
-                    d = json.load(file)
-                    return d
-                
+                return json.loads(d)
             case 'txt':
-                with open(filepath, 'r', encoding='utf-8') as file:
-                    d = file.read()
-                    return d
+                return d
 
+    #The manifest is written after the document, so it never lists a status the document hasn't reached
     def set_status(self, status):
         self.status = status
-        self.save_file(self.doc_status_filepath, status, 'txt')
+        self.save_file(self.doc_status_key, status, 'txt')
+        self.manifest.set(self.doc_id, status)
 
     def get_source(self):
-        source_filepath = os.path.join(self.project_name, 'documents', self.doc_id, 'source.txt')
-        if os.path.exists(source_filepath):
-            return self.load_file(source_filepath, 'txt')
-        else:
-            return None
+        return self.load_file(self.key('source.txt'), 'txt')
 
     def set_source(self, value):
-        source_filepath = os.path.join(self.project_name, 'documents', self.doc_id, 'source.txt')
-        return self.save_file(source_filepath, value, 'txt')
+        return self.save_file(self.key('source.txt'), value, 'txt')
 
     def get_trimmed(self):
-        trimmed_filepath = os.path.join(self.project_name, 'documents', self.doc_id, 'trimmed.txt')
-        if os.path.exists(trimmed_filepath):
-            return self.load_file(trimmed_filepath) 
-        else:
-            return None
+        return self.load_file(self.key('trimmed.txt'))
 
     def set_trimmed(self, value):
-        trimmed_filepath = os.path.join(self.project_name, 'documents', self.doc_id, 'trimmed.txt')
-        self.save_file(trimmed_filepath, value) 
+        self.save_file(self.key('trimmed.txt'), value)
+
+    #Outgoing links found by the extractor, cached alongside the trimmed text
+    def get_links(self):
+        return self.load_file(self.key('links.json'), 'json')
 
+    def set_links(self, links):
+        self.save_file(self.key('links.json'), links, 'json')
+
+    #All sizes written together - chunks from an earlier version of the page are dropped so stale ones don't linger
     def set_chunks(self, chunks, chunk_type):
+        files = {}
         for size in chunks.keys():
-            os.makedirs(os.path.join(self.project_name, 'documents', self.doc_id, 'chunks', chunk_type, size), exist_ok=True)
             for i in range(0, len(chunks[size])):
-                chunk = chunks[size][i]
-                filepath = os.path.join(self.project_name, 'documents', self.doc_id, 'chunks', chunk_type, size, f'{i}.txt')
-                self.save_file(filepath, chunk)
+                files[self.key('chunks', chunk_type, size, f'{i}.txt')] = chunks[size][i]
+        self.store.replace_prefix(self.key('chunks', chunk_type) + '/', files)
 
+    #One bulk read; each size's chunks come back in index order (0.txt, 1.txt, ... 10.txt)
     def get_chunks(self, chunk_type):
+        prefix = self.key('chunks', chunk_type) + '/'
+        found = {}
+        for key, text in self.store.get_prefix(prefix).items():
+            size, name = key[len(prefix):].split('/')
+            found.setdefault(size, []).append((int(name.split('.')[0]), text))
         chunks = {}
-        with os.scandir(os.path.join(self.project_name, 'documents', self.doc_id, 'chunks', chunk_type)) as chunks_folder:
-            for directory in chunks_folder:
-                if directory.is_dir():
-                    chunks[directory.name] = []
-                    with os.scandir(os.path.join(self.project_name, 'documents', self.doc_id, 'chunks', chunk_type, directory.name)) as size_folder:
-                        for chunk in size_folder:
-                            chunk_fp = os.path.join(self.project_name, 'documents', self.doc_id, 'chunks', chunk_type, directory.name, chunk.name)
-                            text = self.load_file(chunk_fp)
-                            chunks[directory.name].append(text)
+        for size in sorted(found.keys()):
+            chunks[size] = [text for i, text in sorted(found[size])]
         return chunks
 
     def set_raw_chunks(self, chunks):
@@ -99,12 +103,47 @@ class Document:
     def get_pretty_chunks(self):
         return self.get_chunks('pretty')
 
+    #Which units of the trimmed text make up each raw chunk, see Refiner.chunk
+    def get_chunk_layout(self):
+        return self.load_file(self.key('chunks', 'layout.json'), 'json')
+
+    def set_chunk_layout(self, layout):
+        self.save_file(self.key('chunks', 'layout.json'), layout, 'json')
+
     def save_synthetic_chunks(self, synth_chunks):
-        os.makedirs(os.path.join(self.project_name, 'documents', self.doc_id,'chunks', 'synthetic'), exist_ok=True)
+        files = {}
         for i in range(0, len(synth_chunks)):
-            filepath = os.path.join(self.project_name, 'documents', self.doc_id,'chunks', 'synthetic', f'{i}.json')
-            self.save_file(filepath, synth_chunks[i], 'json')
-
-    # def get_vectors(self):
-    #     #TODO
-    #     print('TODO GET VECS')
+            files[self.key('chunks', 'synthetic', f'{i}.json')] = self.encode(synth_chunks[i], 'json')
+        self.store.replace_prefix(self.key('chunks', 'synthetic') + '/', files)
+
+    #Results of finished steps of an evaluate that is still running, so a restart doesn't repeat them.
+    #Grouped by step, each result keyed by a hash of its input.
+    def get_progress(self):
+        prefix = self.key('progress') + '/'
+        progress = {}
+        for key, value in self.store.get_prefix(prefix).items():
+            step, name = key[len(prefix):].split('/')
+            progress.setdefault(step, {})[name.split('.')[0]] = json.loads(value)
+        return progress
+
+    def save_progress(self, step, key, value):
+        self.save_file(self.key('progress', step, f'{key}.json'), value, 'json')
+
+    def clear_progress(self):
+        self.store.delete_prefix(self.key('progress') + '/')
+
+    #Small per-document facts - source url, HTTP validators, content hashes
+    def get_meta(self):
+        return self.load_file(self.key('meta.json'), 'json') or {}
+
+    def update_meta(self, **values):
+        meta = self.get_meta()
+        meta.update(values)
+        self.save_file(self.key('meta.json'), meta, 'json')
+
+    #Metadata created by Refiner.evaluate, kept so the index can be rebuilt without LLM calls
+    def set_vectors(self, to_index):
+        self.save_file(self.key('vectors.json'), to_index, 'json')
+
+    def get_vectors(self):
+        return self.load_file(self.key('vectors.json'), 'json')
@@ -0,0 +1,238 @@
+#document_store.py
+import os
+import shutil
+import sqlite3
+import threading
+
+#Where Documents keep their files. Keys are paths relative to project_name/documents
+#(e.g. doc_id/chunks/pretty/h1/0.txt) - the same paths the vector index stores as file_path.
+#Values are text; Document does the JSON encoding.
+#
+#  directory - one file per key under project_name/documents (the original layout)
+#  sqlite    - every key in one table in project_name/documents.sqlite, so a document is a few row
+#              reads instead of dozens of small files, and chunk sets are replaced in one transaction
+#
+#A project uses sqlite once documents.sqlite exists; migrate() moves a project between the two.
+
+BACKENDS = ('directory', 'sqlite')
+
+def sqlite_path(project_name):
+    return os.path.join(project_name, 'documents.sqlite')
+
+def directory_path(project_name):
+    return os.path.join(project_name, 'documents')
+
+#Smallest string greater than every key that starts with prefix - lets a prefix scan use the primary key
+def prefix_end(prefix):
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+class DirectoryStore:
+    backend = 'directory'
+
+    def __init__(self, path):
+        self.path = path
+
+    def filepath(self, key):
+        return os.path.join(self.path, *key.split('/'))
+
+    def get(self, key):
+        filepath = self.filepath(key)
+        if not os.path.exists(filepath):
+            return None
+        with open(filepath, 'r', encoding='utf-8') as file:
+            return file.read()
+
+    def get_many(self, keys):
+        values = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                values[key] = value
+        return values
+
+    #Every key under prefix (a directory, ending in '/') and its value
+    def get_prefix(self, prefix):
+        return self.get_many(self.keys(prefix))
+
+    def put(self, key, value):
+        filepath = self.filepath(key)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, 'w', encoding='utf-8') as file:
+            file.write(value)
+
+    def put_many(self, items):
+        for key, value in items.items():
+            self.put(key, value)
+
+    def delete_prefix(self, prefix):
+        shutil.rmtree(self.filepath(prefix.rstrip('/')), ignore_errors=True)
+
+    #Drop everything under prefix and write items in its place
+    def replace_prefix(self, prefix, items):
+        self.delete_prefix(prefix)
+        self.put_many(items)
+
+    def keys(self, prefix=''):
+        root = self.filepath(prefix.rstrip('/')) if prefix else self.path
+        keys = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            relative = os.path.relpath(dirpath, self.path).replace(os.sep, '/')
+            for filename in filenames:
+                keys.append(filename if relative == '.' else relative + '/' + filename)
+        keys.sort()
+        return keys
+
+    #doc_ids of every stored document
+    def documents(self):
+        if not os.path.isdir(self.path):
+            return []
+        with os.scandir(self.path) as entries:
+            return [entry.name for entry in entries if entry.is_dir()]
+
+    def close(self):
+        pass
+
+class SQLiteStore:
+    backend = 'sqlite'
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.lock = threading.Lock()
+        directory = os.path.dirname(self.filepath)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        #Shared by the threads of one process; pool processes open their own
+        self.connection = sqlite3.connect(self.filepath, timeout=60, check_same_thread=False)
+        #WAL lets the refine threads read while a prepare process writes
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS files (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID')
+        self.connection.commit()
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute('SELECT value FROM files WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def get_many(self, keys):
+        keys = list(keys)
+        values = {}
+        with self.lock:
+            #Stays well under SQLite's limit on bound parameters
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ','.join('?' * len(batch))
+                values.update(self.connection.execute(f'SELECT key, value FROM files WHERE key IN ({placeholders})', batch).fetchall())
+        return values
+
+    def get_prefix(self, prefix):
+        with self.lock:
+            rows = self.connection.execute('SELECT key, value FROM files WHERE key >= ? AND key < ? ORDER BY key', (prefix, prefix_end(prefix))).fetchall()
+        return dict(rows)
+
+    def put(self, key, value):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO files (key, value) VALUES (?, ?)', (key, value))
+            self.connection.commit()
+
+    def put_many(self, items):
+        with self.lock:
+            self.connection.executemany('INSERT OR REPLACE INTO files (key, value) VALUES (?, ?)', items.items())
+            self.connection.commit()
+
+    def delete_prefix(self, prefix):
+        with self.lock:
+            self.connection.execute('DELETE FROM files WHERE key >= ? AND key < ?', (prefix, prefix_end(prefix)))
+            self.connection.commit()
+
+    #One transaction, so readers never see a half-replaced chunk set
+    def replace_prefix(self, prefix, items):
+        with self.lock:
+            self.connection.execute('DELETE FROM files WHERE key >= ? AND key < ?', (prefix, prefix_end(prefix)))
+            self.connection.executemany('INSERT OR REPLACE INTO files (key, value) VALUES (?, ?)', items.items())
+            self.connection.commit()
+
+    def keys(self, prefix=''):
+        with self.lock:
+            if prefix:
+                rows = self.connection.execute('SELECT key FROM files WHERE key >= ? AND key < ? ORDER BY key', (prefix, prefix_end(prefix))).fetchall()
+            else:
+                rows = self.connection.execute('SELECT key FROM files ORDER BY key').fetchall()
+        return [row[0] for row in rows]
+
+    def documents(self):
+        with self.lock:
+            rows = self.connection.execute("SELECT key FROM files WHERE key LIKE '%/status.txt'").fetchall()
+        return [row[0].split('/')[0] for row in rows]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+#One store per project per process
+_stores = {}
+_stores_lock = threading.Lock()
+
+def detect_backend(project_name):
+    return 'sqlite' if os.path.exists(sqlite_path(project_name)) else 'directory'
+
+def get_store(project_name):
+    key = os.path.abspath(project_name)
+    with _stores_lock:
+        if key not in _stores:
+            if detect_backend(project_name) == 'sqlite':
+                _stores[key] = SQLiteStore(sqlite_path(project_name))
+            else:
+                _stores[key] = DirectoryStore(directory_path(project_name))
+        return _stores[key]
+
+#Called once by the KnowledgeBase with the document_store setting. A new project starts on the configured
+#backend; an existing one keeps the backend it has until it is migrated.
+def open_store(project_name, backend=None):
+    current = detect_backend(project_name)
+    if backend == 'sqlite' and current == 'directory' and not os.path.isdir(directory_path(project_name)):
+        SQLiteStore(sqlite_path(project_name)).close()
+        current = 'sqlite'
+    if backend is not None and backend != current:
+        print(f"document_store is '{backend}' but {project_name} uses '{current}'. Run: migrate_store {project_name} {backend}")
+    return get_store(project_name)
+
+#Copy every document into the other backend and switch the project over to it.
+#The old copy is kept (documents/ or documents.sqlite.migrated) until you delete it.
+def migrate(project_name, backend, batch_size=1000):
+    if backend not in BACKENDS:
+        raise Exception(f"Unknown document store '{backend}', use one of {BACKENDS}")
+    source = get_store(project_name)
+    if source.backend == backend:
+        print(f"{project_name} already uses the {backend} document store")
+        return
+
+    match backend:
+        case 'sqlite':
+            final_path = sqlite_path(project_name)
+            build_path = final_path + '.tmp'
+            if os.path.exists(build_path):
+                os.remove(build_path)
+            target = SQLiteStore(build_path)
+        case 'directory':
+            final_path = directory_path(project_name)
+            build_path = final_path + '.tmp'
+            if os.path.exists(final_path):
+                raise Exception(f"{final_path} already exists - move it out of the way first")
+            shutil.rmtree(build_path, ignore_errors=True)
+            target = DirectoryStore(build_path)
+
+    keys = source.keys()
+    for start in range(0, len(keys), batch_size):
+        target.put_many(source.get_many(keys[start:start + batch_size]))
+        print(f"Migrated {min(start + batch_size, len(keys))}/{len(keys)} files")
+    target.close()
+    source.close()
+
+    #Built under a temporary name, so a crash part way leaves the project on the old store
+    if backend == 'directory':
+        os.replace(sqlite_path(project_name), sqlite_path(project_name) + '.migrated')
+    os.replace(build_path, final_path)
+    with _stores_lock:
+        _stores.pop(os.path.abspath(project_name), None)
+    print(f"{project_name} now uses the {backend} document store ({len(keys)} files)")
@@ -0,0 +1,139 @@
+#extractor.py
+import re
+import hashlib
+from bs4 import BeautifulSoup
+from urllib.parse import urljoin, urlparse, urlunparse
+
+#lxml's C parser is much faster than the pure-Python html.parser - use it when installed
+try:
+    import lxml
+    PARSER = 'lxml'
+except ImportError:
+    PARSER = 'html.parser'
+
+#Parse a page once and produce both its outgoing links and its trimmed markdown
+def extract(url, html_content):
+    soup = BeautifulSoup(html_content, PARSER)
+    #Links first - trimming removes nav/header/footer, which is where most of them are
+    links = extract_links(url, soup)
+    trimmed = trim(soup)
+    return links, trimmed
+
+#Extract a document's stored source, reusing the cached links and trimmed text when the source
+#hasn't changed since the last extraction. url defaults to the one recorded when it was downloaded.
+def extract_document(document, url=None):
+    source = document.get_source()
+    if source is None:
+        return [], None
+    source_hash = hashlib.sha256(source.encode('utf-8')).hexdigest()
+    meta = document.get_meta()
+    url = url or meta.get('url', '')
+    #Links are resolved against the url, so a cached result is only good for the same one
+    if meta.get('extracted_hash') == source_hash and meta.get('extracted_url') == url:
+        links = document.get_links()
+        trimmed = document.get_trimmed()
+        if links is not None and trimmed is not None:
+            return links, trimmed
+
+    links, trimmed = extract(url, source)
+    document.set_links(links)
+    document.set_trimmed(trimmed)
+    document.update_meta(extracted_hash=source_hash, extracted_url=url)
+    return links, trimmed
+
+#All hrefs on the page, fragment removed, resolved against the page url
+def extract_links(url, soup):
+    links = []
+    for link in soup.find_all('a', href=True):
+        href = link['href']
+        # Remove fragment part
+        parsed_url = urlparse(href)
+        cleaned_url = urlunparse((parsed_url.scheme, parsed_url.netloc, parsed_url.path, parsed_url.params, parsed_url.query, ''))
+        links.append(urljoin(url, cleaned_url))
+    return links
+
+#Trim html garbage - keeps headings, paragraphs, quotes, lists and tables as markdown-ish text
+def trim(soup):
+    content = []
+    title = soup.find('title')
+    if title and title.text:
+        content.append(f'h1: {title.text}')
+
+    # Remove <header> elements
+    for mal in soup.find_all(['script','header', 'footer', 'nav', 'meta']):
+        mal.decompose()
+
+    elements = soup.body if soup.body is not None else soup
+
+    for element in elements.descendants:
+        if element.name in ['h1', 'h2', 'h3', 'h4', 'h5', 'h6']:
+            content.append(f"\n{element.name}: {element.get_text(strip=True)}\n")
+        elif element.name == 'p':
+            text = element.get_text(strip=True)
+            if text:
+                content.append(f'{text} ')
+        elif element.name == 'blockquote':
+            quote = element.get_text(strip=True)
+            content.append(f"> {quote}\n")
+        elif element.name in ['ul', 'ol']:
+            if 'class' not in element:
+                list_items = [li.get_text(strip=True) for li in element.find_all('li')]
+                if list_items:
+                    content.append('\n'.join([f"- {item}" for item in list_items]) + '\n')
+            else:
+                _class = element['class'][0]
+                if 'nav' not in _class and 'learnMoreSection' not in _class:
+                    list_items = [li.get_text(strip=True) for li in element.find_all('li')]
+                    if list_items:
+                        content.append('\n'.join([f"- {item}" for item in list_items]) + '\n')
+        elif element.name == 'table':
+            table_text = convert_table_to_markdown(element)
+            if table_text:
+                content.append(table_text + '\n')
+
+    #Joined once at the end - joining inside the loop made trimming quadratic in page size
+    full_text = '\n'.join(content)
+
+    # Clean up excessive whitespace
+    full_text = re.sub(r'\n\s*\n', '\n\n', full_text)
+    return full_text.strip()
+
+#ChatGPTed html to markdown for tables.
+def convert_table_to_markdown(table):
+    markdown = []
+    headers = []
+    rows = []
+
+    # Extract table headers
+    header_row = table.find('tr')
+    if not header_row:
+        return ""
+
+    th_tags = header_row.find_all('th')
+    if th_tags:
+        headers = [th.get_text(strip=True) for th in th_tags]
+        rows = table.find_all('tr')[1:]  # Exclude header row
+    else:
+        # If there are no <th>, treat first row as headers
+        td_tags = header_row.find_all('td')
+        headers = [td.get_text(strip=True) for td in td_tags]
+        rows = table.find_all('tr')[1:]
+
+    if not headers:
+        return ""
+
+    # Create Markdown header
+    header_md = '| ' + ' | '.join(headers) + ' |'
+    separator_md = '| ' + ' | '.join(['---'] * len(headers)) + ' |'
+    markdown.append(header_md)
+    markdown.append(separator_md)
+
+    # Add table rows
+    for row in rows:
+        cells = row.find_all(['td', 'th'])
+        row_data = [cell.get_text(strip=True) for cell in cells]
+        row_md = '| ' + ' | '.join(row_data) + ' |'
+        markdown.append(row_md)
+
+    # Combine all parts
+    return '\n'.join(markdown)
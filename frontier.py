@@ -0,0 +1,145 @@
+#frontier.py
+import os
+import json
+import heapq
+import hashlib
+
+from journal import Journal
+
+#Crawl frontier - a priority queue of urls with dedup on enqueue, persisted so a crawl resumes
+#exactly where it stopped. Every url ever enqueued is in the seen set, so it is queued at most once.
+#  frontier/seen.txt    - append-only, one url hash per line
+#  frontier/queue.json  - snapshot of pending urls (written at compaction)
+#  frontier/queue.log   - pushes and completions since the snapshot
+class Frontier:
+    def __init__(self, project_name, max_depth=None, order='bfs'):
+        self.project_name = project_name
+        self.max_depth = max_depth
+        self.order = order
+        self.frontier_path = os.path.join(project_name, 'frontier')
+        self.seen_filepath = os.path.join(self.frontier_path, 'seen.txt')
+        self.queue_filepath = os.path.join(self.frontier_path, 'queue.json')
+        self.journal = Journal(os.path.join(self.frontier_path, 'queue.log'))
+        self.seen = set()
+        self.new_seen = []
+        #Pending entries are [priority, seq, url, depth]; in_flight maps url -> entry until complete()
+        self.heap = []
+        self.in_flight = {}
+        self.seq = 0
+        self.journal_seq = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def has_work(self):
+        return len(self.heap) > 0 or len(self.in_flight) > 0
+
+    def url_key(self, url):
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()[:32]
+
+    def priority(self, depth):
+        match self.order:
+            case 'dfs':
+                return -depth
+            case _:
+                return depth
+
+    #O(1) dedup - urls already seen (queued, in flight or crawled) are dropped
+    def push(self, urls, depth=0):
+        added = 0
+        if self.max_depth is not None and depth > self.max_depth:
+            return added
+        for url in urls:
+            key = self.url_key(url)
+            if key in self.seen:
+                continue
+            self.seen.add(key)
+            self.new_seen.append(key)
+            self.seq += 1
+            heapq.heappush(self.heap, [self.priority(depth), self.seq, url, depth])
+            self.log({'op': 'push', 'url': url, 'depth': depth, 'entry_seq': self.seq})
+            added += 1
+        return added
+
+    def pop(self):
+        if len(self.heap) == 0:
+            return None
+        entry = heapq.heappop(self.heap)
+        self.in_flight[entry[2]] = entry
+        return entry[2]
+
+    #Links found on a page are queued one level deeper, then the page is marked done
+    def complete(self, url, new_links=None):
+        entry = self.in_flight.pop(url, None)
+        if entry is None:
+            return
+        if new_links:
+            self.push(new_links, entry[3] + 1)
+        self.log({'op': 'done', 'entry_seq': entry[1]})
+
+    def log(self, record):
+        self.journal_seq += 1
+        record['seq'] = self.journal_seq
+        self.journal.append(record)
+
+    #Checkpoint - O(changes since the last one)
+    def flush(self):
+        os.makedirs(self.frontier_path, exist_ok=True)
+        if len(self.new_seen) > 0:
+            with open(self.seen_filepath, 'a', encoding='utf-8') as file:
+                file.write('\n'.join(self.new_seen) + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+            self.new_seen = []
+        self.journal.flush()
+
+    #Urls still in flight are written as pending, so a crash never loses them
+    def compact(self):
+        os.makedirs(self.frontier_path, exist_ok=True)
+        self.flush()
+        pending = list(self.heap) + list(self.in_flight.values())
+        snapshot = {'pending': pending, 'seq': self.seq, 'journal_seq': self.journal_seq}
+        with open(self.queue_filepath + '.tmp', 'w', encoding='utf-8') as file:
+            json.dump(snapshot, file)
+        os.replace(self.queue_filepath + '.tmp', self.queue_filepath)
+        self.journal.truncate()
+
+    def load(self):
+        if os.path.exists(self.seen_filepath):
+            with open(self.seen_filepath, 'r', encoding='utf-8') as file:
+                self.seen = set(line.strip() for line in file if line.strip())
+        pending = {}
+        if os.path.exists(self.queue_filepath):
+            with open(self.queue_filepath, 'r', encoding='utf-8') as file:
+                snapshot = json.load(file)
+            for entry in snapshot['pending']:
+                pending[entry[1]] = entry
+            self.seq = snapshot['seq']
+            self.journal_seq = snapshot['journal_seq']
+        for record in self.journal.replay():
+            if record['seq'] <= self.journal_seq:
+                continue
+            match record['op']:
+                case 'push':
+                    pending[record['entry_seq']] = [self.priority(record['depth']), record['entry_seq'], record['url'], record['depth']]
+                    self.seen.add(self.url_key(record['url']))
+                    self.seq = max(self.seq, record['entry_seq'])
+                case 'done':
+                    pending.pop(record['entry_seq'], None)
+            self.journal_seq = record['seq']
+        #Re-key priorities in case the crawl order setting changed
+        self.heap = [[self.priority(e[3]), e[1], e[2], e[3]] for e in pending.values()]
+        heapq.heapify(self.heap)
+        self.in_flight = {}
+        print(f"Frontier: {len(self.heap)} queued, {len(self.seen)} seen")
+
+    #Forget everything - e.g. to revisit every page on a refresh
+    def reset(self):
+        self.seen = set()
+        self.new_seen = []
+        self.heap = []
+        self.in_flight = {}
+        self.journal.truncate()
+        if os.path.exists(self.seen_filepath):
+            os.remove(self.seen_filepath)
+        self.compact()
@@ -0,0 +1,54 @@
+#journal.py
+import os
+import json
+
+#Append-only log of JSON records. Records are buffered until flush(), replayed on load,
+#and dropped when the owner compacts its state into a full snapshot.
+class Journal:
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.pending = []
+
+    def append(self, record):
+        self.pending.append(record)
+
+    def is_dirty(self):
+        return len(self.pending) > 0
+
+    #Write buffered records - cost is O(records since last flush)
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        with open(self.filepath, 'a', encoding='utf-8') as file:
+            for record in self.pending:
+                file.write(json.dumps(record) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+        self.pending = []
+
+    #Read every complete record - a torn tail from a crash is cut off so later appends stay readable.
+    #read_only=True leaves the file alone, e.g. when another process may still be writing to it.
+    def replay(self, read_only=False):
+        records = []
+        if not os.path.exists(self.filepath):
+            return records
+        valid_bytes = 0
+        with open(self.filepath, 'rb') as file:
+            for line in file:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError("incomplete record")
+                    records.append(json.loads(line))
+                except ValueError:
+                    print(f"Ignoring torn journal tail in {self.filepath}")
+                    break
+                valid_bytes += len(line)
+        if not read_only and valid_bytes < os.path.getsize(self.filepath):
+            with open(self.filepath, 'r+b') as file:
+                file.truncate(valid_bytes)
+        return records
+
+    def truncate(self):
+        self.pending = []
+        if os.path.exists(self.filepath):
+            os.remove(self.filepath)
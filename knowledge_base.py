@@ -8,25 +8,43 @@ from crawler import Crawler
 from refiner import Refiner
 from vector_database import VectorDB
 from document import Document
+import document_store
+import manifest
 
-from llm_api import llmAPI
+from journal import Journal
+from frontier import Frontier
+from pipeline import Pipeline
+from llm_batch import ingest as ingest_batch_results
 
 class KnowledgeBase:
     def __init__(self, project_settings):
         self.project_name = project_settings['project_name']
         self.base_url = project_settings['base_url']
         self.project_settings = project_settings
-        self.to_visit = []
+        #Document files - 'directory' (default) or 'sqlite'; existing projects switch with migrate_store
+        self.store = document_store.open_store(self.project_name, project_settings.get('document_store'))
+        #Status of every document, so queues and counts don't have to open each one
+        self.manifest = manifest.get_manifest(self.project_name, self.store)
         self.to_process = []
-        self.crawler = Crawler(self.project_name, self.base_url)
-        self.refiner = Refiner(self.project_name)
-        self.index = VectorDB(self.project_name)
-        self.llm_api = llmAPI()
+        #Crawl queue - deduplicated and persisted under project_name/frontier
+        self.frontier = Frontier(self.project_name, project_settings.get('crawl_max_depth'), project_settings.get('crawl_order', 'bfs'))
+        #Only used to migrate a to_visit list from an older save.json
+        self.to_visit = []
+        self.crawler = Crawler(self.project_name, self.base_url, project_settings)
+        self.refiner = Refiner(self.project_name, project_settings)
+        self.index = VectorDB(self.project_name, project_settings)
+        #Shares the refiner's client and response cache
+        self.llm_api = self.refiner.llm_api
+        #Queue changes between compactions live in save.log; save.json is the last full snapshot
+        self.journal = Journal(os.path.join(self.project_name, 'save.log'))
+        self.journal_seq = 0
+        self.checkpoints = 0
+        self.compact_every = project_settings.get('compact_every', 50)
 
     #Build - Save project settings, save_file, begin update()
     def build(self):
         os.makedirs(self.project_name, exist_ok=True)
-        self.to_visit = [self.base_url]
+        self.frontier.push([self.base_url])
 
         project_settings_filepath = os.path.join(self.project_name, 'project_settings.json')
         with open(project_settings_filepath, 'w') as file:
@@ -34,24 +52,78 @@ class KnowledgeBase:
         save_file_filepath = os.path.join(self.project_name, 'save.json')
 
 
-        self.save()
+        self.save(compact=True)
         self.update()
 
+    #Queue operations - every change is journaled so a checkpoint writes only the delta
+    def next_visit(self):
+        return self.frontier.pop()
+
+    def push_process(self, doc_id):
+        self.to_process.append(doc_id)
+        self.log({'op': 'push_process', 'doc_id': doc_id})
+
+    #A document leaves the queue only once it is indexed (or has nothing to index)
+    def finish_process(self, doc_id):
+        if doc_id in self.to_process:
+            self.to_process.remove(doc_id)
+        self.log({'op': 'finish_process', 'doc_id': doc_id})
+
+    def log(self, record):
+        self.journal_seq += 1
+        record['seq'] = self.journal_seq
+        self.journal.append(record)
+
+    def replay(self, record):
+        match record['op']:
+            case 'push_visit':
+                self.to_visit.extend(record['urls'])
+            case 'pop_visit':
+                self.to_visit.pop()
+            case 'push_process':
+                self.to_process.append(record['doc_id'])
+            case 'pop_process':
+                self.to_process.pop()
+            case 'finish_process':
+                if record['doc_id'] in self.to_process:
+                    self.to_process.remove(record['doc_id'])
+
     #save crawl queue and chunk/process queue incase process is interupted
-    def save(self):
+    #Checkpoints append to the logs; every compact_every saves (and at the end of update) everything is rewritten.
+    #index=False only flushes the queue logs - for checkpoints that can't have changed the index, e.g. after
+    #each crawled page - and doesn't count towards compact_every.
+    def save(self, compact=False, index=True):
         print("Saving")
         try:
-            save_file_filepath = os.path.join(self.project_name, 'save.json')
-            save_file = {'to_visit': self.to_visit, 'to_process': self.to_process}
-            with open(save_file_filepath, 'w') as file:
-                json.dump(save_file, file)
-
-            self.index.save()
+            if not index and not compact:
+                self.frontier.flush()
+                self.journal.flush()
+                return
+            self.checkpoints += 1
+            if compact or self.checkpoints >= self.compact_every:
+                self.compact()
+            else:
+                #Vectors first - if we crash in between, a doc is re-indexed rather than lost
+                self.index.save()
+                self.frontier.flush()
+                self.journal.flush()
         except Exception as e:
             print(e)
             print("Save failed.")
 
-    #load crawl queue and chunk/process queue
+    def compact(self):
+        print("Compacting")
+        self.index.save(compact=True)
+        self.frontier.compact()
+        save_file_filepath = os.path.join(self.project_name, 'save.json')
+        save_file = {'to_process': self.to_process, 'journal_seq': self.journal_seq}
+        with open(save_file_filepath + '.tmp', 'w') as file:
+            json.dump(save_file, file)
+        os.replace(save_file_filepath + '.tmp', save_file_filepath)
+        self.journal.truncate()
+        self.checkpoints = 0
+
+    #load crawl queue and chunk/process queue, then replay changes logged since the last compaction
     def load(self):
         print("Load Saved Data.")
         try:
@@ -60,118 +132,132 @@ class KnowledgeBase:
             if os.path.exists(save_file_filepath):
                 with open(save_file_filepath, 'r') as file:
                     save_file = json.load(file)
-                    print(save_file)
                 if 'to_visit' in save_file:
                     self.to_visit = save_file['to_visit']
                 if 'to_process' in save_file:
                     self.to_process = save_file['to_process']
+                self.journal_seq = save_file.get('journal_seq', 0)
 
-            print(self.to_visit)
+            replayed = 0
+            for record in self.journal.replay():
+                #Records at or below journal_seq are already in save.json
+                if record['seq'] > self.journal_seq:
+                    self.replay(record)
+                    self.journal_seq = record['seq']
+                    replayed += 1
+            self.frontier.load()
+            if len(self.to_visit) > 0:
+                print(f"Moving {len(self.to_visit)} urls from save.json into the frontier")
+                self.frontier.push(self.to_visit)
+                self.to_visit = []
+            print(f"to_visit: {len(self.frontier)}, to_process: {len(self.to_process)}, replayed: {replayed}")
             self.index.load()
 
         except Exception as e:
             print(e)
             print("Load Failed.")
 
-    #Update - Crawl any new pages, process downloaded pages into chunks + search metadata, update vectorDB
+    #Update - Crawl any new pages, process downloaded pages into chunks + search metadata, update vectorDB.
+    #All stages run concurrently, see Pipeline.
     def update(self):
         try:
-            #Visit New Pages
-            print("Explore")
-            while len(self.to_visit) > 0:
-                url = self.to_visit.pop()
-                print(url)
-                try:
-                    doc_id, new_links = self.crawler.crawl(url)
-                    if doc_id is not None:
-                        self.to_process.append(doc_id)
-                    if len(new_links) > 0:
-                        self.to_visit = self.to_visit + new_links
-                        self.save()
-                except Exception as e:
-                    print(e)
-            print("Explore Complete")
-            
-            print("Process Documents")
-            while len(self.to_process) > 0:
-                print(f"Count remaining to_process: {len(self.to_process)}")
-                doc_id = self.to_process.pop()
-                print(doc_id)
-                try:
-                    to_index = self.refiner.process(doc_id)
-                    if to_index:
-                        print("start indexing")
-                        self.index.index(to_index)
-
-                except Exception as e:
-                    print("Exception:")
-                    print(e)
-                self.save()
-
-            print()
-
+            Pipeline(self, self.project_settings.get('pipeline')).run()
         except Exception as e:
             print(e)
             self.save()
 
         #ends with save
-        self.save()
+        self.save(compact=True)
+
+    #Refresh - recrawl from the base url with conditional requests; only pages whose text changed are reprocessed
+    def refresh(self):
+        self.crawler.refresh = True
+        self.frontier.reset()
+        self.frontier.push([self.base_url])
+        self.update()
 
     #Add all discovered documents to the queue
     def process_all_documents(self):
-        self.to_process = []
-        with os.scandir(os.path.join(self.project_name, 'documents')) as documents:
-            for entry in documents:
-                if entry.is_dir():
-                    print(entry.name)
-                    doc = Document(self.project_name, entry.name)
-                    if doc.status == 'DOWNLOADED':
-                        self.to_process.append(doc.doc_id)
-                    if doc.status == 'TRIMMED':
-                        self.to_process.append(doc.doc_id)
-                    if doc.status == 'CHUNKED':
-                        self.to_process.append(doc.doc_id)
-                    print(f"DocStatus - {doc.status}")
-        print(f"to_process: {self.to_process}")
-        self.save()
+        self.to_process = self.manifest.documents('DOWNLOADED', 'TRIMMED', 'CHUNKED', 'PRETTIFIED')
+        print(f"to_process: {len(self.to_process)} documents")
+        self.save(compact=True)
         self.update()
+    #Batch mode - a refine round makes no LLM calls. Every call that isn't answered by the response cache
+    #is written to project_name/batch/requests_*.jsonl for the OpenAI Batch API, and documents advance as far
+    #as the cache allows. Submit the files, then batch_ingest the results; repeat until nothing is pending.
+    def batch_emit(self):
+        batch = self.llm_api.start_batch(os.path.join(self.project_name, 'batch'), self.project_settings.get('batch_max_requests', 50000))
+        self.process_all_documents()
+        filepaths = batch.write()
+        print(f"{len(batch)} requests pending in {len(filepaths)} batch files: {filepaths}")
+        return filepaths
+
+    #Load Batch API result files into the response cache, then run the next round
+    def batch_ingest(self, result_filepaths):
+        for filepath in result_filepaths:
+            ingest_batch_results(self.llm_api.cache, filepath)
+        return self.batch_emit()
+
+    #Rebuild the vector index from the metadata saved on every processed document
+    def reindex(self):
+        self.index = VectorDB(self.project_name, self.project_settings)
+        to_index = {'topics': [], 'keywords': [], 'questions': []}
+        for doc_id in self.manifest.documents('PROCESSED'):
+            doc_vectors = Document(self.project_name, doc_id).get_vectors()
+            if doc_vectors:
+                for key in to_index.keys():
+                    to_index[key].extend(doc_vectors.get(key, []))
+        print(f"Reindexing {len(to_index['topics'])} topics, {len(to_index['keywords'])} keywords, {len(to_index['questions'])} questions")
+        self.index.index(to_index)
+        self.save(compact=True)
+
     #Search (kNN) 
+    #The query is embedded once and the same vector is searched in all three indexes.
+    #The index is read once, so a reload swapping it mid-request can't mix generations.
     def search(self, query, t_k=3, q_k=5, k_k=10):
-        topic_vectors = self.index.search('topics', query, 1)
+        index = self.index
+        query_vector = index.embed_query(query)
+
+        topic_vectors = index.search('topics', query, 1, query_vector)
         topic_vectors.sort(reverse=True, key=lambda x: x['distance'])
 
-        question_vectors = self.index.search('questions', query, q_k)
+        question_vectors = index.search('questions', query, q_k, query_vector)
         question_vectors.sort(reverse=True, key=lambda x: x['distance'])
 
-        keyword_vectors = self.index.search('keywords', query, k_k)
+        keyword_vectors = index.search('keywords', query, k_k, query_vector)
         keyword_vectors.sort(reverse=True, key=lambda x: x['distance'])
 
         return {'topics': topic_vectors, 'questions': question_vectors, 'keywords': keyword_vectors}
 
+    #Batch search - all queries embedded together, one matrix multiply per index.
+    #Each index maps to arrays shaped (len(queries), k), nearest first.
+    def search_many(self, queries, t_k=1, q_k=5, k_k=10):
+        index = self.index
+        query_vectors = index.embed_queries(queries)
+        return {'topics': index.search_many('topics', query_vectors, t_k),
+                'questions': index.search_many('questions', query_vectors, q_k),
+                'keywords': index.search_many('keywords', query_vectors, k_k)}
+
     #Answer - RAG based off search results
     def answer(self, query):
         print(f"Answer: {query}")
         results = self.search(query)
+        #file_path is a document store key - every result's text is read in one go
+        texts = self.store.get_many({result['file_path'] for results_of_type in results.values() for result in results_of_type})
         for topic in results['topics']:
-            tfp = os.path.join(self.project_name, 'documents', topic['file_path'])
-            with open(tfp, 'r', encoding='utf-8') as file:
-                t_text = file.read()
+            t_text = texts.get(topic['file_path'], '')
             for question in results['questions']:
-                qfp = os.path.join(self.project_name, 'documents', question['file_path'])
-                with open(qfp, 'r', encoding='utf-8') as file:
-                    q_text = file.read()
-                answer = self.llm_api.answer_query(query, t_text, q_text)
+                q_text = texts.get(question['file_path'], '')
+                answer = self.llm_api.answer_query_structured(query, t_text, q_text)
                 if answer:
                     print("AND THE ANSWER IS!")
                     return answer
         print("No Exact answers, check keyword results:")
         for k in results['keywords']:
-            kfp = os.path.join(self.project_name, 'documents', k['file_path'])
-            with open(kfp, 'r', encoding='utf-8') as file:
-                k_text = file.read()
-                answer = self.llm_api.answer_if_possible(query, k_text)
-                if answer:
-                    return answer
+            k_text = texts.get(k['file_path'], '')
+            answer = self.llm_api.answer_if_possible_structured(query, k_text)
+            if answer:
+                return answer
         return None
 
 if __name__ == "__main__":
@@ -204,6 +290,11 @@ if __name__ == "__main__":
                         kb = KnowledgeBase(project_settings)
                         kb.load()
                         kb.update()
+                    case 'refresh':
+                        print('ACTION SELECTED: REFRESH')
+                        kb = KnowledgeBase(project_settings)
+                        kb.load()
+                        kb.refresh()
                     case 'process_all':
                         print("PROCESS ALL DOCS")
                         print("Loading Knowledge Base")
@@ -211,6 +302,48 @@ if __name__ == "__main__":
                         kb.load()
                         kb.process_all_documents()
 
+                    case 'batch_emit':
+                        print('ACTION SELECTED: BATCH EMIT')
+                        kb = KnowledgeBase(project_settings)
+                        kb.load()
+                        kb.batch_emit()
+                    case 'batch_ingest':
+                        print('ACTION SELECTED: BATCH INGEST')
+                        kb = KnowledgeBase(project_settings)
+                        kb.load()
+                        kb.batch_ingest(sys.argv[3:])
+
+                    case 'reindex':
+                        print('ACTION SELECTED: REINDEX')
+                        kb = KnowledgeBase(project_settings)
+                        kb.load()
+                        kb.reindex()
+
+                    case 'status':
+                        print('ACTION SELECTED: STATUS')
+                        store = document_store.get_store(project_name)
+                        if len(sys.argv) > 3 and sys.argv[3] == 'rebuild':
+                            manifest.rebuild(project_name, store)
+                        counts = manifest.get_manifest(project_name, store).counts()
+                        for status, count in counts.items():
+                            print(f"{status}: {count}")
+                        print(f"total: {sum(counts.values())}")
+
+                    case 'migrate_store':
+                        print('ACTION SELECTED: MIGRATE STORE')
+                        backend = sys.argv[3]
+                        document_store.migrate(project_name, backend)
+                        project_settings['document_store'] = backend
+                        with open(project_settings_filepath, 'w') as file:
+                            json.dump(project_settings, file)
+
+                    case 'recall':
+                        print('ACTION SELECTED: RECALL')
+                        kb = KnowledgeBase(project_settings)
+                        kb.load()
+                        for name, report in kb.index.recall_report().items():
+                            print(f"{name}: {report}")
+
                     case 'search':
                         print('ACTION SELECTED: SEARCH')
                         query = sys.argv[3]
@@ -218,6 +351,28 @@ if __name__ == "__main__":
                         kb.load()
                         results = kb.search(query)
                         print(results)
+                    case 'search_many':
+                        print('ACTION SELECTED: SEARCH MANY')
+                        queries_filepath = sys.argv[3]
+                        output_filepath = sys.argv[4] if len(sys.argv) > 4 else 'search_results.jsonl'
+                        with open(queries_filepath, 'r', encoding='utf-8') as file:
+                            queries = [line.strip() for line in file if line.strip()]
+                        kb = KnowledgeBase(project_settings)
+                        kb.load()
+                        results = kb.search_many(queries)
+                        with open(output_filepath, 'w', encoding='utf-8') as file:
+                            for i in range(len(queries)):
+                                row = {'query': queries[i]}
+                                for search_type, result in results.items():
+                                    hits = result['indices'][i] >= 0
+                                    row[search_type] = [{'file_path': fp, 'distance': float(d)} for fp, d in zip(result['file_paths'][i][hits], result['distances'][i][hits])]
+                                file.write(json.dumps(row) + '\n')
+                        print(f"Wrote results for {len(queries)} queries to {output_filepath}")
+                    case 'serve':
+                        print('ACTION SELECTED: SERVE')
+                        from server import KnowledgeBaseServer
+                        port = int(sys.argv[3]) if len(sys.argv) > 3 else 8765
+                        KnowledgeBaseServer(project_settings, port=port).serve()
                     case 'answer':
                         print('ACTION SELECTED: ANSWER')
                         query = sys.argv[3]
@@ -1,200 +1,577 @@
 #llm_api.py
 import openai
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
+import asyncio
+import random
 import time
+import json
 import ast
 
-##LLM API - interface with openAI
-class llmAPI():
-    def __init__(self):
-        #run - export OPENAI_API_KEY="your open api key" - in terminal
-        self.client = OpenAI()
+from llm_cache import LLMCache
+from llm_batch import BatchWriter, BatchPending
+
+#Prompts - shared by the blocking and the async client so both send (and cache) exactly the same calls
+def prettify_messages(text):
+    return [
+        {"role": "system", "content": "Correct the grammar. Respond with only the corrected version of the user input"},
+        {"role": "user", "content": text},
+        {"role": "assistant", "content": "The corrected text is:"}
+    ]
+
+def keywords_messages(text):
+    return [
+        {"role": "system", "content": f"The following text is from a Help Guide. Generate keywords a user may search that this Help Guide directly answers. Respond with only an array containing each keyword.\nHelp Guide:\n"},
+        {"role": "user", "content": text}
+    ]
+
+def questions_messages(text):
+    return [
+        {"role": "system", "content": f"The following text is from a Help Guide. Generate all simple questions a user may ask that this Help Guide directly answers. Respond with only an array containing each sentence.\nHelp Guide:\n"},
+        {"role": "user", "content": text}
+    ]
+
+def questions_validation_messages(messages, response_text):
+    return messages + [
+        {"role": "assistant", "content": response_text},
+        {"role": "user", "content": "Do these questions accurately cover the content of the article? True or False."}
+    ]
+
+def relevance_messages(question, text):
+    return [
+        {"role": "system", "content": "Using no other information than the given Source Text, can you answer the given Question? Respond with only True or False\n"},
+        {"role": "assistant", "content": "Source Text: "},
+        {"role": "user", "content": text},
+        {"role": "assistant", "content": "Question: "},
+        {"role": "user", "content": question},
+        {"role": "user", "content": "Using no other information than the Source Text, do you have the information needed to answer the Question? True or False."}
+    ]
+
+def relevance_score_messages(messages):
+    return messages + [
+        {"role": "assistant", "content": "True"},
+        {"role": "user", "content": "Score how relevant the Source Text is to the Question on a scale of [0 - 10].\n The Score will be 0 if the Source Text is not relevant to the question. The Score will be 10 if it perfectly answers the question.\nScore will be closer to 0 if the Source Text contains irrelevant information or not enough information to answer the quesion\n"},
+        {"role": "user", "content": "Respond with only the Score, an integer [0 - 10]"}
+    ]
+
+def relevance_batch_messages(questions, text):
+    numbered = '\n'.join(f"{i + 1}. {question}" for i, question in enumerate(questions))
+    return [
+        {"role": "system", "content": "Using no other information than the given Source Text, score how well it answers each of the numbered Questions on a scale of [0 - 10].\nThe Score will be 0 if the Source Text does not have the information needed to answer the question. The Score will be 10 if it perfectly answers the question.\nScore will be closer to 0 if the Source Text contains irrelevant information or not enough information to answer the quesion\nRespond with only a JSON array of integers, one Score per Question, in the same order.\n"},
+        {"role": "assistant", "content": "Source Text: "},
+        {"role": "user", "content": text},
+        {"role": "assistant", "content": "Questions: "},
+        {"role": "user", "content": numbered}
+    ]
+
+#Expected reply to relevance_batch_messages - a JSON array of one integer 0-10 per question
+def parse_relevance_scores(response_text, count):
+    response_text = response_text.strip()
+    if response_text.startswith('```'):
+        response_text = response_text.strip('`')
+        if response_text.startswith('json'):
+            response_text = response_text[4:]
+    scores = json.loads(response_text)
+    if not isinstance(scores, list) or len(scores) != count:
+        raise ValueError(f"expected a list of {count} scores, got: {response_text[:200]}")
+    for score in scores:
+        if isinstance(score, bool) or not isinstance(score, (int, float)) or score != int(score) or not 0 <= score <= 10:
+            raise ValueError(f"invalid score {score!r}")
+    return [int(score) for score in scores]
+
+def answer_check_messages(query, topic, highlight):
+    return [
+        {"role": "system", "content": "The following text is from a Help Guide. Use only the user provided content to answer the Final Question.\nHelp Guide:\n"},
+        {"role": "user", "content": topic},
+        {"role": "user", "content": "\n The following highlight provides content that may be relevant in answering the Final Question.\nHighlight:\n"},
+        {"role": "user", "content": highlight},
+        {"role": "user", "content": "\nThe following line is the Final Question. Do not answer yet. Using the user provided content, can you answer the question? Respond with only True or False\n"},
+        {"role": "user", "content": f"The Question: {query}\n"},
+        {"role": "user", "content": "True or False?"},
+    ]
+
+def answer_messages(query, topic, highlight):
+    return [
+        {"role": "system", "content": "The following text is from a Help Guide. Use only the user provided content to answer the Final Question.\nHelp Guide:\n"},
+        {"role": "user", "content": topic},
+        {"role": "user", "content": "\n The following highlight provides content that may be relevant in answering the Final Question.\nHighlight:\n"},
+        {"role": "user", "content": highlight},
+        {"role": "user", "content": "\nThe following line is the Final Question. Do not answer yet. Using the user provided content, can you answer the question? Respond with only True or False\n"},
+        {"role": "user", "content": f"The Question: {query}\n"},
+        {"role": "assistant", "content": "True"},
+        {"role": "user", "content": "Answer the Final Question, using exact text from the above excepts to answer the question as much as possible.\n\n"},
+        {"role": "user", "content": query},
+    ]
+
+def context_check_messages(query, context_text):
+    return [
+        {"role": "system", "content": "The following text is from a Help Guide. Use only the user provided content to answer the Final Question.\nHelp Guide:\n"},
+        {"role": "user", "content": context_text},
+        {"role": "user", "content": "\nThe following line is the Final Question. Do not answer yet. Using the user provided content, can you answer the question? Respond with only True or False\n"},
+        {"role": "user", "content": f"The Question: {query}\n"},
+        {"role": "user", "content": "True or False?"},
+    ]
+
+def context_answer_messages(query, context_text):
+    return [
+        {"role": "system", "content": "The following text is from a Help Guide. Use only the user provided content to answer the Final Question.\nHelp Guide:\n"},
+        {"role": "user", "content": context_text},
+        {"role": "user", "content": "\nThe following line is the Final Question. Do not answer yet. Using the user provided content, can you answer the question? Respond with only True or False\n"},
+        {"role": "user", "content": f"The Question: {query}\n"},
+        {"role": "assistant", "content": "True"},
+        {"role": "user", "content": "Answer the Final Question, using exact text from the above excepts to answer the question as much as possible.\n\n"},
+        {"role": "user", "content": query},
+    ]
+
+#Structured variants - one call returns what the check-then-ask pairs above take two calls for
+def questions_structured_messages(text):
+    return [
+        {"role": "system", "content": f"The following text is from a Help Guide. Generate all simple questions a user may ask that this Help Guide directly answers, then check whether together they accurately cover the content of the article.\nRespond with only a JSON object: {{\"questions\": [each question], \"covers_content\": true or false}}\nHelp Guide:\n"},
+        {"role": "user", "content": text}
+    ]
+
+ANSWER_STRUCTURED_INSTRUCTIONS = "\nThe following line is the Final Question. Using only the user provided content, can you answer the question? If you can, answer it using exact text from the above excepts as much as possible.\nRespond with only a JSON object: {\"answerable\": true or false, \"answer\": the answer, or an empty string if not answerable}\n"
+
+def answer_structured_messages(query, topic, highlight):
+    return [
+        {"role": "system", "content": "The following text is from a Help Guide. Use only the user provided content to answer the Final Question.\nHelp Guide:\n"},
+        {"role": "user", "content": topic},
+        {"role": "user", "content": "\n The following highlight provides content that may be relevant in answering the Final Question.\nHighlight:\n"},
+        {"role": "user", "content": highlight},
+        {"role": "user", "content": ANSWER_STRUCTURED_INSTRUCTIONS},
+        {"role": "user", "content": f"The Question: {query}\n"},
+    ]
+
+def context_structured_messages(query, context_text):
+    return [
+        {"role": "system", "content": "The following text is from a Help Guide. Use only the user provided content to answer the Final Question.\nHelp Guide:\n"},
+        {"role": "user", "content": context_text},
+        {"role": "user", "content": ANSWER_STRUCTURED_INSTRUCTIONS},
+        {"role": "user", "content": f"The Question: {query}\n"},
+    ]
 
+def parse_structured_answer(response_text):
+    result = json.loads(response_text)
+    if not isinstance(result, dict) or not isinstance(result.get('answerable'), bool):
+        raise ValueError(f"expected {{answerable, answer}}, got: {response_text[:200]}")
+    if not result['answerable']:
+        return None
+    if not isinstance(result.get('answer'), str) or not result['answer'].strip():
+        raise ValueError(f"answerable without an answer: {response_text[:200]}")
+    return result['answer'].strip()
+
+def parse_structured_questions(response_text):
+    result = json.loads(response_text)
+    if not isinstance(result, dict) or not isinstance(result.get('questions'), list) or not isinstance(result.get('covers_content'), bool):
+        raise ValueError(f"expected {{questions, covers_content}}, got: {response_text[:200]}")
+    if not all(isinstance(question, str) for question in result['questions']):
+        raise ValueError("questions must be strings")
+    return result['questions'], result['covers_content']
+
+def json_params(json_mode):
+    return {'response_format': {'type': 'json_object'}} if json_mode else {}
+
+def make_cache(cache_path, cache_settings):
+    cache_settings = cache_settings or {}
+    if cache_path is None or not cache_settings.get('enabled', True):
+        return None
+    return LLMCache(cache_path,
+                    max_bytes=cache_settings.get('max_mb', 512) * 1024 * 1024,
+                    bypass=cache_settings.get('bypass', False))
+
+#What an LLM method asks of the client running it - see LLMMethods
+class Chat:
+    def __init__(self, messages, json_mode=False):
+        self.messages = messages
+        self.json_mode = json_mode
+
+#Drop cached responses that turned out to be unusable, so retrying asks the model again
+class Forget:
+    def __init__(self, *message_lists, json_mode=False):
+        self.message_lists = message_lists
+        self.json_mode = json_mode
+
+#Run several methods' steps - one after another in llmAPI, all at once in AsyncLLMAPI
+class Gather:
+    def __init__(self, steps):
+        self.steps = steps
+
+##The LLM methods, written once for both clients. Each *_steps generator yields Chat/Forget/Gather requests
+#and gets back the reply (or has the request's exception raised inside it); its return value is the result.
+#llmAPI.run performs the requests with blocking calls, AsyncLLMAPI.run awaits them.
+class LLMMethods():
     def prettify(self, text):
+        return self.run(self.prettify_steps(text))
+
+    def prettify_steps(self, text):
         try:
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "Correct the grammar. Respond with only the corrected version of the user input"},
-                    {"role": "user", "content": text},
-                    {"role": "assistant", "content": "The corrected text is:"}
-              ]
-            )
+            pretty_text = yield Chat(prettify_messages(text))
             # Extract the corrected text
-            pretty_text = response.choices[0].message.content.strip()
-            return pretty_text
+            return pretty_text.strip()
+        except BatchPending:
+            raise
         except Exception as e:
             print(f"Failed to get response: {e}")
             raise e
 
     def generate_keywords(self, text):
+        return self.run(self.generate_keywords_steps(text))
+
+    def generate_keywords_steps(self, text):
         print("GEN KEYWORDS")
+        messages = keywords_messages(text)
         try:
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": f"The following text is from a Help Guide. Generate keywords a user may search that this Help Guide directly answers. Respond with only an array containing each keyword.\nHelp Guide:\n"},
-                    {"role": "user", "content": text}
-              ]
-            )
-               
-            keywords = ast.literal_eval(response.choices[0].message.content.strip())
+            keywords = ast.literal_eval((yield Chat(messages)).strip())
             return keywords
-
+        except BatchPending:
+            raise
         except Exception as e:
             print(f"Failed to get response: {e}")
+            yield Forget(messages)
             raise e
 
     def generate_potential_questions(self, text):
+        return self.run(self.generate_potential_questions_steps(text))
+
+    def generate_potential_questions_steps(self, text):
         print("GEN Qs")
+        messages = questions_messages(text)
+        validation_messages = None
         try:
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": f"The following text is from a Help Guide. Generate all simple questions a user may ask that this Help Guide directly answers. Respond with only an array containing each sentence.\nHelp Guide:\n"},
-                    {"role": "user", "content": text}
-              ]
-            )
-            response_text = response.choices[0].message.content.strip()
-               
-            questions = ast.literal_eval(response.choices[0].message.content.strip())
-
-            validation = self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": f"The following text is from a Help Guide. Generate all simple questions a user may ask that this Help Guide directly answers. Respond with only an array containing each sentence.\nHelp Guide:\n"},
-                    {"role": "user", "content": text},
-                    {"role": "assistant", "content": response_text},
-                    {"role": "user", "content": "Do these questions accurately cover the content of the article? True or False."}
-              ]
-            )
-            if 'true' in validation.choices[0].message.content.lower():
+            response_text = (yield Chat(messages)).strip()
+
+            questions = ast.literal_eval(response_text)
+
+            validation_messages = questions_validation_messages(messages, response_text)
+            validation = yield Chat(validation_messages)
+            if 'true' in validation.lower():
                 return questions
             else:
                 raise Exception("validation failed")
+        except BatchPending:
+            raise
         except Exception as e:
             print(f"Failed to get response: {e}")
+            yield Forget(messages, validation_messages or [])
             raise e
 
-    def get_embedding(self, text):
-        text = text.replace("\n", " ")
-        return self.client.embeddings.create(input = [text], model="text-embedding-3-small").data[0].embedding
+    #Questions and their validation in one call. Falls back to generate_potential_questions on a malformed reply.
+    def generate_potential_questions_structured(self, text):
+        return self.run(self.generate_potential_questions_structured_steps(text))
+
+    def generate_potential_questions_structured_steps(self, text):
+        print("GEN Qs")
+        messages = questions_structured_messages(text)
+        try:
+            questions, covers_content = parse_structured_questions((yield Chat(messages, json_mode=True)))
+        except BatchPending:
+            raise
+        except (ValueError, TypeError) as e:
+            print(f"Unusable structured questions, asking in two steps: {e}")
+            yield Forget(messages, json_mode=True)
+            return (yield from self.generate_potential_questions_steps(text))
+        if not covers_content:
+            yield Forget(messages, json_mode=True)
+            raise Exception("validation failed")
+        return questions
 
     #check groundedness and if answer is possible, return relevance score.
     def evaluate_relevance(self, question, text):
+        return self.run(self.evaluate_relevance_steps(question, text))
+
+    def evaluate_relevance_steps(self, question, text):
         print(f"GEN EVAL: {question}")
+        messages = relevance_messages(question, text)
+        score_messages = relevance_score_messages(messages)
         try:
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "Using no other information than the given Source Text, can you answer the given Question? Respond with only True or False\n"},
-                    {"role": "assistant", "content": "Source Text: "},
-                    {"role": "user", "content": text},
-                    {"role": "assistant", "content": "Question: "},
-                    {"role": "user", "content": question},
-                    {"role": "user", "content": "Using no other information than the Source Text, do you have the information needed to answer the Question? True or False."}
-              ]
-            )
-            # Extract the corrected text
-            is_relevant = 'true' in response.choices[0].message.content.lower()
+            is_relevant = 'true' in (yield Chat(messages)).lower()
 
             if not is_relevant:
                 return 0
 
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "Using no other information than the given Source Text, can you answer the given Question? Respond with only True or False\n"},
-                    {"role": "assistant", "content": "Source Text: "},
-                    {"role": "user", "content": text},
-                    {"role": "assistant", "content": "Question: "},
-                    {"role": "user", "content": question},
-                    {"role": "user", "content": "Using no other information than the Source Text, do you have the information needed to answer the Question? True or False."},
-                    {"role": "assistant", "content": "True"},
-                    {"role": "user", "content": "Score how relevant the Source Text is to the Question on a scale of [0 - 10].\n The Score will be 0 if the Source Text is not relevant to the question. The Score will be 10 if it perfectly answers the question.\nScore will be closer to 0 if the Source Text contains irrelevant information or not enough information to answer the quesion\n"},
-                    {"role": "user", "content": "Respond with only the Score, an integer [0 - 10]"}
-              ]
-            )
-            # Extract the corrected text
-            print(response.choices[0].message.content.strip())
-            relavancy_score = int(response.choices[0].message.content.strip())
+            response_text = (yield Chat(score_messages)).strip()
+            print(response_text)
+            relavancy_score = int(response_text)
             return relavancy_score
 
+        except BatchPending:
+            raise
         except Exception as e:
             print(f"Failed to get response: {e}")
+            yield Forget(score_messages)
             raise e
 
+    #Score several questions against one text in a single call. Falls back to evaluate_relevance
+    #for each question when the reply isn't a valid list of scores.
+    def evaluate_relevance_batch(self, questions, text):
+        return self.run(self.evaluate_relevance_batch_steps(questions, text))
+
+    def evaluate_relevance_batch_steps(self, questions, text):
+        print(f"GEN EVAL: {len(questions)} questions")
+        messages = relevance_batch_messages(questions, text)
+        try:
+            return parse_relevance_scores((yield Chat(messages)), len(questions))
+        except BatchPending:
+            raise
+        except (ValueError, TypeError) as e:
+            print(f"Unusable relevance scores, scoring one by one: {e}")
+            yield Forget(messages)
+            return (yield Gather([self.evaluate_relevance_steps(question, text) for question in questions]))
+
     #Answer user query with context given by vector db
     def answer_query(self, query, topic, highlight):
+        return self.run(self.answer_query_steps(query, topic, highlight))
+
+    def answer_query_steps(self, query, topic, highlight):
         try:
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "The following text is from a Help Guide. Use only the user provided content to answer the Final Question.\nHelp Guide:\n"},
-                    {"role": "user", "content": topic},
-                    {"role": "user", "content": "\n The following highlight provides content that may be relevant in answering the Final Question.\nHighlight:\n"},
-                    {"role": "user", "content": highlight},
-                    {"role": "user", "content": "\nThe following line is the Final Question. Do not answer yet. Using the user provided content, can you answer the question? Respond with only True or False\n"},
-                    {"role": "user", "content": f"The Question: {query}\n"},
-                    {"role": "user", "content": "True or False?"},
-
-              ]
-            )
-            can_answer = response.choices[0].message.content.strip().lower()
+            can_answer = (yield Chat(answer_check_messages(query, topic, highlight))).strip().lower()
             if 'true' in can_answer:
-                response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "The following text is from a Help Guide. Use only the user provided content to answer the Final Question.\nHelp Guide:\n"},
-                    {"role": "user", "content": topic},
-                    {"role": "user", "content": "\n The following highlight provides content that may be relevant in answering the Final Question.\nHighlight:\n"},
-                    {"role": "user", "content": highlight},
-                    {"role": "user", "content": "\nThe following line is the Final Question. Do not answer yet. Using the user provided content, can you answer the question? Respond with only True or False\n"},
-                    {"role": "user", "content": f"The Question: {query}\n"},
-                    {"role": "assistant", "content": "True"},
-                    {"role": "user", "content": "Answer the Final Question, using exact text from the above excepts to answer the question as much as possible.\n\n"},
-                    {"role": "user", "content": query},
-              ]
-            )
-                answer = response.choices[0].message.content.strip()
+                answer = (yield Chat(answer_messages(query, topic, highlight))).strip()
                 return answer
-            else: 
+            else:
                 return None
+        except BatchPending:
+            raise
         except Exception as e:
             print(f"Failed to get response: {e}")
             raise e
 
     #answer with context of matching keywords
     def answer_if_possible(self, query, context_text):
+        return self.run(self.answer_if_possible_steps(query, context_text))
+
+    def answer_if_possible_steps(self, query, context_text):
         try:
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "The following text is from a Help Guide. Use only the user provided content to answer the Final Question.\nHelp Guide:\n"},
-                    {"role": "user", "content": context_text},
-                    {"role": "user", "content": "\nThe following line is the Final Question. Do not answer yet. Using the user provided content, can you answer the question? Respond with only True or False\n"},
-                    {"role": "user", "content": f"The Question: {query}\n"},
-                    {"role": "user", "content": "True or False?"},
-              ]
-            )
-            can_answer = response.choices[0].message.content.strip().lower()
+            can_answer = (yield Chat(context_check_messages(query, context_text))).strip().lower()
             if 'true' in can_answer:
-                response = self.client.chat.completions.create(
-                    model="gpt-4o-mini",
-                    messages=[
-                        {"role": "system", "content": "The following text is from a Help Guide. Use only the user provided content to answer the Final Question.\nHelp Guide:\n"},
-                        {"role": "user", "content": context_text},
-                        {"role": "user", "content": "\nThe following line is the Final Question. Do not answer yet. Using the user provided content, can you answer the question? Respond with only True or False\n"},
-                        {"role": "user", "content": f"The Question: {query}\n"},
-                        {"role": "assistant", "content": "True"},
-                        {"role": "user", "content": "Answer the Final Question, using exact text from the above excepts to answer the question as much as possible.\n\n"},
-                        {"role": "user", "content": query},
-                    ]
-                )
-                answer = response.choices[0].message.content.strip()
+                answer = (yield Chat(context_answer_messages(query, context_text))).strip()
                 return answer
-            else: 
+            else:
                 return None
+        except BatchPending:
+            raise
         except Exception as e:
             print(f"Failed to get response: {e}")
             raise e
+
+    #answer_query and answer_if_possible in one call each - {answerable, answer}. The answer or None,
+    #falling back to the two-call version on a malformed reply.
+    def answer_query_structured(self, query, topic, highlight):
+        return self.run(self.answer_query_structured_steps(query, topic, highlight))
+
+    def answer_query_structured_steps(self, query, topic, highlight):
+        messages = answer_structured_messages(query, topic, highlight)
+        try:
+            return parse_structured_answer((yield Chat(messages, json_mode=True)))
+        except BatchPending:
+            raise
+        except (ValueError, TypeError) as e:
+            print(f"Unusable structured answer, asking in two steps: {e}")
+            yield Forget(messages, json_mode=True)
+            return (yield from self.answer_query_steps(query, topic, highlight))
+
+    def answer_if_possible_structured(self, query, context_text):
+        return self.run(self.answer_if_possible_structured_steps(query, context_text))
+
+    def answer_if_possible_structured_steps(self, query, context_text):
+        messages = context_structured_messages(query, context_text)
+        try:
+            return parse_structured_answer((yield Chat(messages, json_mode=True)))
+        except BatchPending:
+            raise
+        except (ValueError, TypeError) as e:
+            print(f"Unusable structured answer, asking in two steps: {e}")
+            yield Forget(messages, json_mode=True)
+            return (yield from self.answer_if_possible_steps(query, context_text))
+
+##LLM API - interface with openAI
+class llmAPI(LLMMethods):
+    def __init__(self, cache_path=None, cache_settings=None):
+        #run - export OPENAI_API_KEY="your open api key" - in terminal
+        self.client = OpenAI()
+        self.model = "gpt-4o-mini"
+        #Responses are cached on disk when a cache_path is given - see llm_cache.py
+        self.cache = make_cache(cache_path, cache_settings)
+        #Batch mode - cache misses are recorded for a Batch API file instead of sent, see llm_batch.py
+        self.batch = None
+
+    def start_batch(self, batch_path, max_requests=50000):
+        if self.cache is None:
+            raise Exception("Batch mode needs the LLM response cache, check the llm_cache setting")
+        self.batch = BatchWriter(batch_path, max_requests)
+        return self.batch
+
+    #Drive a method's steps, performing each request as it comes
+    def run(self, steps):
+        reply = None
+        error = None
+        while True:
+            try:
+                request = steps.throw(error) if error is not None else steps.send(reply)
+            except StopIteration as stop:
+                return stop.value
+            reply = None
+            error = None
+            try:
+                match request:
+                    case Chat():
+                        reply = self._chat(request.messages, request.json_mode)
+                    case Forget():
+                        self._forget(*request.message_lists, json_mode=request.json_mode)
+                    case Gather():
+                        reply = [self.run(step) for step in request.steps]
+            except Exception as e:
+                error = e
+
+    #Every chat completion goes through here - answered from the cache when the same call was made before
+    #json_mode asks for a JSON object reply (structured output)
+    def _chat(self, messages, json_mode=False):
+        params = json_params(json_mode)
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(self.model, messages, **params)
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+        if self.batch is not None:
+            self.batch.add(key, self.model, messages, **params)
+            raise BatchPending()
+        response = self.client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            **params
+        )
+        content = response.choices[0].message.content
+        if self.cache is not None:
+            self.cache.set(key, self.model, content)
+        return content
+
+    def _forget(self, *message_lists, json_mode=False):
+        if self.cache is not None:
+            for messages in message_lists:
+                self.cache.delete(self.cache.key(self.model, messages, **json_params(json_mode)))
+
+    def get_embedding(self, text):
+        text = text.replace("\n", " ")
+        return self.client.embeddings.create(input = [text], model="text-embedding-3-small").data[0].embedding
+
+#Per-minute allowance (requests or tokens), refilled continuously. Only used from one event loop.
+class RateBudget:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.available = per_minute
+        self.updated = time.monotonic()
+
+    async def acquire(self, amount=1):
+        amount = min(amount, self.capacity)
+        while True:
+            now = time.monotonic()
+            self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.available >= amount:
+                self.available -= amount
+                return
+            await asyncio.sleep((amount - self.available) / self.rate)
+
+##Async LLM API - the same methods as llmAPI, awaitable, so hundreds of calls can be in flight at once.
+#At most `concurrency` requests are open, requests and estimated tokens stay within the per-minute budgets,
+#and 429s, timeouts and 5xx are retried with jittered exponential backoff (or the server's Retry-After).
+#The response cache is SQLite, so it is read and written in the loop's executor. Use one instance per event loop.
+class AsyncLLMAPI(LLMMethods):
+    def __init__(self, cache=None, settings=None):
+        settings = settings or {}
+        self.model = "gpt-4o-mini"
+        self.cache = cache
+        self.concurrency = settings.get('concurrency', 32)
+        self.max_retries = settings.get('max_retries', 6)
+        self.max_backoff = settings.get('max_backoff', 60)
+        #Retries are handled here, where they respect the budgets
+        self.client = AsyncOpenAI(max_retries=0, timeout=settings.get('timeout', 60))
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.requests_budget = RateBudget(settings.get('requests_per_minute', 500))
+        self.tokens_budget = RateBudget(settings.get('tokens_per_minute', 200000))
+        self.retries = 0
+
+    #Same as llmAPI.run, awaiting each request - Gather runs its steps concurrently
+    async def run(self, steps):
+        reply = None
+        error = None
+        while True:
+            try:
+                request = steps.throw(error) if error is not None else steps.send(reply)
+            except StopIteration as stop:
+                return stop.value
+            reply = None
+            error = None
+            try:
+                match request:
+                    case Chat():
+                        reply = await self._chat(request.messages, request.json_mode)
+                    case Forget():
+                        await self._forget(*request.message_lists, json_mode=request.json_mode)
+                    case Gather():
+                        reply = list(await asyncio.gather(*[self.run(step) for step in request.steps]))
+            except Exception as e:
+                error = e
+
+    #Rough count - about four characters a token, plus room for the reply
+    def estimate_tokens(self, messages):
+        return sum(len(message['content']) for message in messages) // 4 + 256
+
+    def is_retryable(self, e):
+        if isinstance(e, (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)):
+            return True
+        return isinstance(e, openai.APIStatusError) and e.status_code >= 500
+
+    def backoff(self, attempt, e):
+        delay = min(self.max_backoff, 2 ** attempt) * (0.5 + random.random() / 2)
+        response = getattr(e, 'response', None)
+        if response is not None:
+            try:
+                if response.headers.get('retry-after-ms'):
+                    delay = float(response.headers['retry-after-ms']) / 1000
+                elif response.headers.get('retry-after'):
+                    delay = float(response.headers['retry-after'])
+            except ValueError:
+                pass
+        return max(0, min(delay, self.max_backoff))
+
+    async def _chat(self, messages, json_mode=False):
+        loop = asyncio.get_running_loop()
+        params = json_params(json_mode)
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(self.model, messages, **params)
+            cached = await loop.run_in_executor(None, self.cache.get, key)
+            if cached is not None:
+                return cached
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                async with self.semaphore:
+                    await self.requests_budget.acquire()
+                    await self.tokens_budget.acquire(self.estimate_tokens(messages))
+                    response = await self.client.chat.completions.create(
+                        model=self.model,
+                        messages=messages,
+                        **params
+                    )
+                break
+            except Exception as e:
+                if not self.is_retryable(e) or attempt >= self.max_retries:
+                    raise e
+                delay = self.backoff(attempt, e)
+                print(f"LLM call failed ({e.__class__.__name__}), retry {attempt} in {delay:.1f}s")
+                self.retries += 1
+                await asyncio.sleep(delay)
+        content = response.choices[0].message.content
+        if self.cache is not None:
+            await loop.run_in_executor(None, self.cache.set, key, self.model, content)
+        return content
+
+    async def _forget(self, *message_lists, json_mode=False):
+        if self.cache is not None:
+            loop = asyncio.get_running_loop()
+            for messages in message_lists:
+                await loop.run_in_executor(None, self.cache.delete, self.cache.key(self.model, messages, **json_params(json_mode)))
@@ -0,0 +1,70 @@
+#llm_batch.py
+import os
+import json
+import threading
+
+#Raised by an LLM call in batch mode when its response isn't in the cache yet - the request has been
+#recorded for the next batch file instead of being sent
+class BatchPending(Exception):
+    pass
+
+#Collects the chat completions the refine stage is waiting on and writes them in OpenAI Batch API format.
+#The custom_id of each request is its response cache key, so results drop straight into the cache.
+class BatchWriter:
+    def __init__(self, batch_path, max_requests=50000):
+        self.batch_path = batch_path
+        self.max_requests = max_requests
+        self.requests = {}
+        self.lock = threading.Lock()
+
+    def add(self, key, model, messages, **params):
+        with self.lock:
+            if key not in self.requests:
+                self.requests[key] = {'custom_id': key,
+                                      'method': 'POST',
+                                      'url': '/v1/chat/completions',
+                                      'body': {'model': model, 'messages': messages, **params}}
+
+    def __len__(self):
+        return len(self.requests)
+
+    #One file per max_requests (the Batch API limit per file). Files from an earlier round are replaced.
+    def write(self):
+        os.makedirs(self.batch_path, exist_ok=True)
+        for entry in os.scandir(self.batch_path):
+            if entry.name.startswith('requests_') and entry.name.endswith('.jsonl'):
+                os.remove(entry.path)
+        requests = list(self.requests.values())
+        filepaths = []
+        for start in range(0, len(requests), self.max_requests):
+            filepath = os.path.join(self.batch_path, f'requests_{start // self.max_requests}.jsonl')
+            with open(filepath, 'w', encoding='utf-8') as file:
+                for request in requests[start:start + self.max_requests]:
+                    file.write(json.dumps(request) + '\n')
+            filepaths.append(filepath)
+        return filepaths
+
+#Load a Batch API results file into the response cache. Failed or missing results are skipped and
+#will be requested again in the next batch, so partial and repeated result files are fine.
+def ingest(cache, filepath):
+    loaded = 0
+    failed = 0
+    with open(filepath, 'r', encoding='utf-8') as file:
+        for line in file:
+            if not line.strip():
+                continue
+            try:
+                result = json.loads(line)
+                response = result.get('response') or {}
+                if result.get('error') or response.get('status_code') != 200:
+                    failed += 1
+                    continue
+                body = response['body']
+                content = body['choices'][0]['message']['content']
+                cache.set(result['custom_id'], body.get('model'), content)
+                loaded += 1
+            except (ValueError, KeyError, IndexError, TypeError) as e:
+                print(f"Skipping unreadable result: {e}")
+                failed += 1
+    print(f"Ingested {loaded} responses from {filepath}, {failed} failed")
+    return loaded, failed
@@ -0,0 +1,95 @@
+#llm_cache.py
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+#Persistent cache of LLM responses, content-addressed by a hash of the model and the exact messages sent.
+#Identical calls - e.g. reprocessing unchanged chunks after a crash - are answered from disk.
+#Least recently used entries are evicted once the stored responses pass max_bytes.
+class LLMCache:
+    def __init__(self, filepath, max_bytes=512 * 1024 * 1024, bypass=False):
+        self.filepath = filepath
+        self.max_bytes = max_bytes
+        #Bypass - always call the API, but still store the fresh response
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = None
+        self.total_bytes = 0
+
+    #Opened on first use, so processes that never call the LLM never touch the file
+    def connect(self):
+        if self.connection is None:
+            directory = os.path.dirname(self.filepath)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.connection = sqlite3.connect(self.filepath, timeout=30, check_same_thread=False)
+            #WAL lets a server read while an update writes
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, model TEXT, response TEXT, size INTEGER, last_used REAL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)')
+            self.connection.commit()
+            self.total_bytes = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        return self.connection
+
+    def key(self, model, messages, **params):
+        payload = json.dumps({'model': model, 'messages': messages, 'params': params}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        if self.bypass:
+            self.misses += 1
+            return None
+        with self.lock:
+            connection = self.connect()
+            row = connection.execute('SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            connection.execute('UPDATE responses SET last_used = ? WHERE key = ?', (time.time(), key))
+            connection.commit()
+            self.hits += 1
+            return row[0]
+
+    def set(self, key, model, response):
+        size = len(response.encode('utf-8'))
+        with self.lock:
+            connection = self.connect()
+            old = connection.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            if old is not None:
+                self.total_bytes -= old[0]
+            connection.execute('INSERT OR REPLACE INTO responses (key, model, response, size, last_used) VALUES (?, ?, ?, ?, ?)', (key, model, response, size, time.time()))
+            self.total_bytes += size
+            if self.total_bytes > self.max_bytes:
+                self.evict(connection)
+            connection.commit()
+
+    #Drop least recently used responses until the cache is back under 90% of max_bytes
+    def evict(self, connection):
+        target = self.max_bytes * 0.9
+        rows = connection.execute('SELECT key, size FROM responses ORDER BY last_used').fetchall()
+        evicted = []
+        for key, size in rows:
+            if self.total_bytes <= target:
+                break
+            evicted.append((key,))
+            self.total_bytes -= size
+        connection.executemany('DELETE FROM responses WHERE key = ?', evicted)
+        print(f"LLM cache: evicted {len(evicted)} responses")
+
+    #Forget a response - used when it could not be parsed or failed validation, so a retry asks again
+    def delete(self, key):
+        with self.lock:
+            connection = self.connect()
+            old = connection.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            if old is not None:
+                connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+                connection.commit()
+                self.total_bytes -= old[0]
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'bytes': self.total_bytes}
@@ -0,0 +1,96 @@
+#manifest.py
+import os
+import time
+import sqlite3
+import threading
+
+#Status of every document in one indexed table (project_name/status.sqlite), kept up to date by
+#Document.set_status. Finding the documents in a status, or counting them, is one query instead of
+#opening every document.
+class StatusManifest:
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.lock = threading.Lock()
+        directory = os.path.dirname(self.filepath)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(self.filepath, timeout=60, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS status (doc_id TEXT PRIMARY KEY, status TEXT, updated REAL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS status_status ON status (status)')
+        self.connection.commit()
+
+    def set(self, doc_id, status):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO status (doc_id, status, updated) VALUES (?, ?, ?)', (doc_id, status, time.time()))
+            self.connection.commit()
+
+    def set_many(self, statuses):
+        now = time.time()
+        with self.lock:
+            self.connection.executemany('INSERT OR REPLACE INTO status (doc_id, status, updated) VALUES (?, ?, ?)', [(doc_id, status, now) for doc_id, status in statuses.items()])
+            self.connection.commit()
+
+    #Every status at once, in one transaction - readers see the old table or the new one, never a mix
+    def replace(self, statuses):
+        now = time.time()
+        with self.lock:
+            self.connection.execute('DELETE FROM status')
+            self.connection.executemany('INSERT INTO status (doc_id, status, updated) VALUES (?, ?, ?)', [(doc_id, status, now) for doc_id, status in statuses.items()])
+            self.connection.commit()
+
+    def get(self, doc_id):
+        with self.lock:
+            row = self.connection.execute('SELECT status FROM status WHERE doc_id = ?', (doc_id,)).fetchone()
+        return row[0] if row else None
+
+    #doc_ids in any of the given statuses, oldest change first
+    def documents(self, *statuses):
+        with self.lock:
+            if statuses:
+                placeholders = ','.join('?' * len(statuses))
+                rows = self.connection.execute(f'SELECT doc_id FROM status WHERE status IN ({placeholders}) ORDER BY updated', statuses).fetchall()
+            else:
+                rows = self.connection.execute('SELECT doc_id FROM status ORDER BY updated').fetchall()
+        return [row[0] for row in rows]
+
+    def counts(self):
+        with self.lock:
+            rows = self.connection.execute('SELECT status, COUNT(*) FROM status GROUP BY status ORDER BY status').fetchall()
+        return dict(rows)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+def manifest_path(project_name):
+    return os.path.join(project_name, 'status.sqlite')
+
+#Read every document's status from the store - for projects from before the manifest, or if it is lost.
+#Rewritten in place inside the existing database, so processes that have it open keep a valid connection.
+#The statuses are read before the manifest is touched, so a crash part way leaves it as it was.
+def rebuild(project_name, store):
+    doc_ids = store.documents()
+    statuses = {}
+    for start in range(0, len(doc_ids), 1000):
+        keys = [doc_id + '/status.txt' for doc_id in doc_ids[start:start + 1000]]
+        statuses.update({key.split('/')[0]: status for key, status in store.get_many(keys).items()})
+    with _manifests_lock:
+        key = os.path.abspath(project_name)
+        if key not in _manifests:
+            _manifests[key] = StatusManifest(manifest_path(project_name))
+        _manifests[key].replace(statuses)
+    print(f"Status manifest rebuilt from {len(doc_ids)} documents")
+
+#One manifest per project per process
+_manifests = {}
+_manifests_lock = threading.RLock()
+
+def get_manifest(project_name, store=None):
+    key = os.path.abspath(project_name)
+    with _manifests_lock:
+        if store is not None and key not in _manifests and not os.path.exists(manifest_path(project_name)):
+            rebuild(project_name, store)
+        if key not in _manifests:
+            _manifests[key] = StatusManifest(manifest_path(project_name))
+        return _manifests[key]
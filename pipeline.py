@@ -0,0 +1,220 @@
+#pipeline.py
+import os
+import queue
+import asyncio
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from refiner import Refiner
+from document import Document
+from llm_batch import BatchPending
+
+#Statuses a prepared document can be in that still need the LLM stages
+NEEDS_REFINE = ('CHUNKED', 'PRETTIFIED')
+
+#One Refiner per pool process, created on first use
+_refiner = None
+
+#Runs in a pool process - trim and chunk (CPU only), stops before the LLM stages.
+#Returns the document's status before and after.
+def prepare_document(project_name, doc_id, project_settings=None):
+    global _refiner
+    if _refiner is None:
+        _refiner = Refiner(project_name, project_settings)
+    before = Document(project_name, doc_id).status
+    _refiner.process(doc_id, stop_at=NEEDS_REFINE)
+    return before, Document(project_name, doc_id).status
+
+#Staged update - every stage runs at once, connected by bounded queues so a fast stage waits for a slow one
+#  crawl (crawler thread pool) -> prepare: trim + chunk (process pool) -> refine: prettify + evaluate (LLM threads) -> index writer
+#Documents stay in the KnowledgeBase's to_process until the writer has indexed them, so an interrupted run resumes them.
+#Status transitions are recorded on each Document as before.
+class Pipeline:
+    def __init__(self, kb, settings=None):
+        self.kb = kb
+        settings = settings or {}
+        self.prepare_workers = settings.get('prepare_workers', min(4, os.cpu_count() or 1))
+        self.refine_workers = settings.get('refine_workers', 8)
+        self.queue_size = settings.get('queue_size', 32)
+        #Async refine - one event loop thread refines up to refine_workers documents at a time through AsyncLLMAPI
+        #Batch mode makes no API calls, so there is nothing to gain from it
+        self.async_refine = settings.get('async_refine', False) and kb.llm_api.batch is None
+        self.refine_consumers = 1 if self.async_refine else self.refine_workers
+
+        self.prepare_queue = queue.Queue(self.queue_size)
+        self.refine_queue = queue.Queue(self.queue_size)
+        self.index_queue = queue.Queue(self.queue_size)
+        #KnowledgeBase queues, journal and index are shared by the crawl thread and the index writer
+        self.lock = threading.Lock()
+        self.queued = set()
+        #Documents left in to_process by an interrupted run
+        self.resumed = set()
+        self.remaining = {'prepare': self.prepare_workers, 'refine': self.refine_consumers}
+        self.remaining_lock = threading.Lock()
+        self.counts = {'crawled': 0, 'indexed': 0, 'unchanged': 0, 'skipped': 0, 'batched': 0, 'failed': 0}
+
+    def run(self):
+        #Pool processes are spawned rather than forked - forking after the crawler threads start is unsafe
+        with ProcessPoolExecutor(max_workers=self.prepare_workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            threads = [threading.Thread(target=self.crawl, daemon=True)]
+            threads += [threading.Thread(target=self.prepare, args=(pool,), daemon=True) for i in range(self.prepare_workers)]
+            if self.async_refine:
+                threads += [threading.Thread(target=asyncio.run, args=(self.refine_async(),), daemon=True)]
+            else:
+                threads += [threading.Thread(target=self.refine, daemon=True) for i in range(self.refine_workers)]
+            for thread in threads:
+                thread.start()
+            self.write()
+            for thread in threads:
+                thread.join()
+        print(f"Pipeline complete: {self.counts}")
+        print(f"Relevance pre-filter saved {self.kb.refiner.relevance_pairs_skipped} LLM relevance checks")
+        if self.kb.llm_api.cache is not None:
+            print(f"LLM cache: {self.kb.llm_api.cache.stats()}")
+
+    #Stage 1 - documents left over from an earlier run go first, then everything the crawl turns up
+    def crawl(self):
+        try:
+            for doc_id in list(self.kb.to_process):
+                self.resumed.add(doc_id)
+                self.enqueue(doc_id, journaled=True)
+
+            print("Explore")
+            for url, doc_id, new_links, error in self.kb.crawler.crawl_many(self.next_visit):
+                print(url)
+                with self.lock:
+                    if error is not None:
+                        print(error)
+                        self.kb.frontier.complete(url)
+                    else:
+                        self.kb.frontier.complete(url, new_links)
+                    self.kb.save(index=False)
+                if error is None and doc_id is not None:
+                    self.count('crawled')
+                    self.enqueue(doc_id)
+            print("Explore Complete")
+        except Exception as e:
+            print(e)
+        finally:
+            for i in range(self.prepare_workers):
+                self.prepare_queue.put(None)
+
+    def next_visit(self):
+        with self.lock:
+            return self.kb.next_visit()
+
+    #Blocks while the prepare queue is full - that is what holds the crawl back
+    def enqueue(self, doc_id, journaled=False):
+        with self.lock:
+            if doc_id in self.queued:
+                return
+            self.queued.add(doc_id)
+            if not journaled:
+                self.kb.push_process(doc_id)
+        self.prepare_queue.put(doc_id)
+
+    #Stage 2 - hands documents to the process pool one at a time per thread, so at most prepare_workers are in flight
+    def prepare(self, pool):
+        while True:
+            doc_id = self.prepare_queue.get()
+            if doc_id is None:
+                break
+            try:
+                before, status = pool.submit(prepare_document, self.kb.project_name, doc_id, self.kb.project_settings).result()
+                if status in NEEDS_REFINE:
+                    self.refine_queue.put(doc_id)
+                elif status == 'PROCESSED' and before == 'PROCESSED' and doc_id in self.resumed:
+                    #Refined by an interrupted run that stopped before indexing it
+                    self.index_queue.put((doc_id, Document(self.kb.project_name, doc_id).get_vectors()))
+                elif status == 'PROCESSED' and before != 'PROCESSED':
+                    #Trimmed text unchanged since it was last processed
+                    self.count('unchanged')
+                    self.index_queue.put((doc_id, None))
+                else:
+                    #Already indexed, or failed to download
+                    self.count('skipped')
+                    self.index_queue.put((doc_id, None))
+            except Exception as e:
+                print(f"Prepare failed for {doc_id}: {e}")
+                self.count('failed')
+                self.index_queue.put((doc_id, None))
+        self.stage_done('prepare', self.refine_queue, self.refine_consumers)
+
+    #Stage 3 - prettify and evaluate; threads, since the time is spent waiting on the LLM API
+    def refine(self):
+        while True:
+            doc_id = self.refine_queue.get()
+            if doc_id is None:
+                break
+            try:
+                to_index = self.kb.refiner.process(doc_id)
+                self.index_queue.put((doc_id, to_index))
+            except BatchPending:
+                #Waiting on the next batch - picked up again by the next batch round
+                self.count('batched')
+                self.index_queue.put((doc_id, None))
+            except Exception as e:
+                print(f"Refine failed for {doc_id}: {e}")
+                self.count('failed')
+                self.index_queue.put((doc_id, None))
+        self.stage_done('refine', self.index_queue, 1)
+
+    #Stage 3, async - documents are refined concurrently and each fans its LLM calls out
+    async def refine_async(self):
+        loop = asyncio.get_running_loop()
+        #Made here, in the loop it will run on
+        api = self.kb.refiner.make_async_llm_api()
+        tasks = set()
+        while True:
+            doc_id = await loop.run_in_executor(None, self.refine_queue.get)
+            if doc_id is None:
+                break
+            tasks.add(asyncio.create_task(self.refine_document(doc_id, api)))
+            if len(tasks) >= self.refine_workers:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        if tasks:
+            await asyncio.wait(tasks)
+        self.stage_done('refine', self.index_queue, 1)
+
+    async def refine_document(self, doc_id, api):
+        loop = asyncio.get_running_loop()
+        try:
+            to_index = await self.kb.refiner.process_async(doc_id, api)
+        except Exception as e:
+            print(f"Refine failed for {doc_id}: {e}")
+            self.count('failed')
+            to_index = None
+        await loop.run_in_executor(None, self.index_queue.put, (doc_id, to_index))
+
+    def count(self, key):
+        with self.remaining_lock:
+            self.counts[key] += 1
+
+    #The last worker of a stage to finish tells every worker of the next stage to stop
+    def stage_done(self, stage, next_queue, next_workers):
+        with self.remaining_lock:
+            self.remaining[stage] -= 1
+            last = self.remaining[stage] == 0
+        if last:
+            for i in range(next_workers):
+                next_queue.put(None)
+
+    #Stage 4 - the only writer of the vector index; checkpoints after every document
+    def write(self):
+        while True:
+            item = self.index_queue.get()
+            if item is None:
+                break
+            doc_id, to_index = item
+            with self.lock:
+                try:
+                    if to_index:
+                        print(f"start indexing {doc_id}")
+                        self.kb.index.index(to_index)
+                        self.count('indexed')
+                except Exception as e:
+                    print("Exception:")
+                    print(e)
+                self.kb.finish_process(doc_id)
+                self.kb.save()
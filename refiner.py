@@ -1,213 +1,338 @@
 #refiner.py
+import os
 import re
-from bs4 import BeautifulSoup
+import json
+import asyncio
+import inspect
+import hashlib
+import numpy as np
 from document import Document
+import extractor
+import tokenizer
 
-from llm_api import llmAPI
+from llm_api import llmAPI, AsyncLLMAPI
+from llm_batch import BatchPending
+from vector_database import get_model, DEFAULT_MODEL
+from ann_index import normalize
 
 #Refine webpage data into vectors for search
 class Refiner():
-    def __init__(self, project_name):
+    def __init__(self, project_name, project_settings=None):
         self.project_name = project_name
-        self.llm_api = llmAPI()
-
-    #Process document - trim, chunk, create metadata for vectors
-    def process(self, doc_id):
+        self.project_settings = project_settings or {}
+        #LLM responses are cached per project, so reprocessing unchanged chunks costs no API calls
+        self.llm_api = llmAPI(os.path.join(project_name, 'llm_cache.sqlite'), self.project_settings.get('llm_cache'))
+        #Question/chunk pairs the embedding pre-filter kept away from the LLM, see shortlist
+        self.relevance_pairs_skipped = 0
+
+    #Process document - trim, chunk, prettify, create metadata for vectors.
+    #Runs from whatever status the document is in through to PROCESSED, or until it reaches a status in stop_at.
+    def process(self, doc_id, stop_at=()):
         doc = Document(self.project_name, doc_id)
 
-        match doc.status:
-            case 'ERROR':
-                print('STATUS IN ERROR')
-                return None
-            case 'DOWNLOADED':
-                print("status: DOWNLOADED")
-                self.trim(doc)
-                self.chunk(doc)
+        while True:
+            if doc.status in stop_at:
                 return None
-            case 'CHUNKED':
-                print("status: CHUNKED")
-                to_index = self.evaluate(doc)
-                return to_index
-            case 'PROCESSED':
-                return doc.get_vectors()
-            case _:
-                print('unkown status')
-
-    #Trim html garbage with BeautifulSoup
+            match doc.status:
+                case 'ERROR':
+                    print('STATUS IN ERROR')
+                    return None
+                case 'DOWNLOADED':
+                    print("status: DOWNLOADED")
+                    trimmed = self.trim(doc)
+                    #Re-downloaded page whose text is what we already processed - skip the LLM stages
+                    if doc.get_meta().get('processed_hash') == self.text_hash(trimmed):
+                        print("Trimmed text unchanged since last processed")
+                        doc.set_status('PROCESSED')
+                        return None
+                case 'TRIMMED':
+                    print("status: TRIMMED")
+                    self.chunk(doc)
+                case 'CHUNKED':
+                    print("status: CHUNKED")
+                    self.prettify_chunks(doc)
+                case 'PRETTIFIED':
+                    print("status: PRETTIFIED")
+                    to_index = self.evaluate(doc)
+                    return to_index
+                case 'PROCESSED':
+                    return doc.get_vectors()
+                case _:
+                    print('unkown status')
+                    return None
+
+    #Same as process, but the LLM stages go through the async client with their calls fanned out.
+    #api is an AsyncLLMAPI made for the running event loop, see make_async_llm_api.
+    async def process_async(self, doc_id, api):
+        #Trimming and chunking are CPU and store work, see blocking
+        await self.blocking(self.process, doc_id, ('CHUNKED', 'PRETTIFIED'))
+        doc = await self.blocking(Document, self.project_name, doc_id)
+        if doc.status == 'CHUNKED':
+            print("status: CHUNKED")
+            await self.prettify_chunks_async(doc, api)
+        if doc.status == 'PRETTIFIED':
+            print("status: PRETTIFIED")
+            return await self.evaluate_async(doc, api)
+        if doc.status == 'PROCESSED':
+            return await self.blocking(doc.get_vectors)
+        return None
+
+    #An async client for one event loop - its semaphore and HTTP client belong to the loop that made them,
+    #so each run makes its own. Shares the response cache with llm_api.
+    def make_async_llm_api(self):
+        return AsyncLLMAPI(self.llm_api.cache, self.project_settings.get('llm_async'))
+
+    #One structured LLM call per chunk scores every question that shortlisted it (relevance_batch_size
+    #questions at most per call). Returns {(question index, chunk): score}.
+    #Each call's scores are saved to the document's progress as they arrive; calls already there aren't repeated.
+    async def score_relevance(self, api, questions, candidates, document=None, done=None):
+        batch_size = self.project_settings.get('relevance_batch_size', 20)
+        by_chunk = {}
+        for i in range(len(candidates)):
+            for chunk in candidates[i]:
+                by_chunk.setdefault(chunk, []).append(i)
+        jobs = []
+        for chunk, indices in by_chunk.items():
+            for start in range(0, len(indices), batch_size):
+                jobs.append((chunk, indices[start:start + batch_size]))
+        print(f"Scoring relevance in {len(jobs)} calls")
+
+        done = done if done is not None else {}
+        async def score(chunk, batch):
+            key = self.text_hash(json.dumps([chunk, batch]))
+            if key not in done:
+                done[key] = await self.call(api.evaluate_relevance_batch, batch, chunk)
+                if document is not None:
+                    await self.blocking(document.save_progress, 'relevance', key, done[key])
+            return done[key]
+        results = await self.gather(*[score(chunk, [questions[i] for i in indices]) for chunk, indices in jobs])
+        scores = {}
+        for (chunk, indices), chunk_scores in zip(jobs, results):
+            for i, score in zip(indices, chunk_scores):
+                scores[(i, chunk)] = score
+        return scores
+
+    #Local pre-filter for relevance scoring - only the relevance_top_n chunks most similar to a question
+    #(and at least relevance_min_similarity) are sent to the LLM. Chunks keep their h3, h2, h1 order.
+    #relevance_top_n of 0 scores every chunk.
+    def shortlist(self, questions, chunks):
+        top_n = self.project_settings.get('relevance_top_n', 5)
+        min_similarity = self.project_settings.get('relevance_min_similarity', 0.2)
+        total = len(questions) * len(chunks)
+        if not top_n or len(questions) == 0 or len(chunks) == 0:
+            print(f"Evaluating {len(questions)} questions against {len(chunks)} chunks")
+            return [chunks for q in questions]
+
+        #Each distinct chunk is embedded once, all questions in one batch
+        model = get_model(self.project_settings.get('embedding_model', DEFAULT_MODEL))
+        distinct = list(dict.fromkeys(chunks))
+        chunk_vectors = normalize(np.asarray(model.encode(distinct), dtype=np.float32).reshape(len(distinct), -1))
+        question_vectors = normalize(np.asarray(model.encode(questions), dtype=np.float32).reshape(len(questions), -1))
+        similarities = question_vectors @ chunk_vectors.T
+
+        row_of = {chunk: i for i, chunk in enumerate(distinct)}
+        candidates = []
+        for q in range(len(questions)):
+            order = np.argsort(-similarities[q])[:top_n]
+            keep = set(int(i) for i in order if min_similarity is None or similarities[q, i] >= min_similarity)
+            candidates.append([chunk for chunk in chunks if row_of[chunk] in keep])
+
+        scored = sum(len(c) for c in candidates)
+        self.relevance_pairs_skipped += total - scored
+        print(f"Relevance pre-filter: scoring {scored} of {total} question/chunk pairs, saved {total - scored} LLM relevance checks")
+        return candidates
+
+    def text_hash(self, text):
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    #Trim html garbage - parsed once by the extractor, which also produced the page's links while crawling
     def trim(self, document):
         print(f"Trimming Doc: {document.doc_id}")
-        source = document.get_source()
-        soup = BeautifulSoup(source, 'html.parser')
-
-        content = []
-        title = soup.find('title')
-        if title and title.text:
-            content.append(f'h1: {title.text}')
-
-        # Remove <header> elements
-        for mal in soup.find_all(['script','header', 'footer', 'nav', 'meta']):
-            mal.decompose()
-
-        elements = soup.body
-
-        for element in elements.descendants:
-            if element.name in ['h1', 'h2', 'h3', 'h4', 'h5', 'h6']:
-                content.append(f"\n{element.name}: {element.get_text(strip=True)}\n")
-            elif element.name == 'p':
-                text = element.get_text(strip=True)
-                if text:
-                    content.append(f'{text} ')
-            elif element.name == 'blockquote':
-                quote = element.get_text(strip=True)
-                content.append(f"> {quote}\n")
-            elif element.name in ['ul', 'ol']:
-                if 'class' not in element:
-                    list_items = [li.get_text(strip=True) for li in element.find_all('li')]
-                    if list_items:
-                        content.append('\n'.join([f"- {item}" for item in list_items]) + '\n')
-                else:
-                    _class = element['class'][0]
-                    if 'nav' not in _class and 'learnMoreSection' not in _class:
-                        list_items = [li.get_text(strip=True) for li in element.find_all('li')]
-                        if list_items:
-                            content.append('\n'.join([f"- {item}" for item in list_items]) + '\n')
-            elif element.name == 'table':
-                table_text = self.convert_table_to_markdown(element)
-                if table_text:
-                    content.append(table_text + '\n')
-
-
-            full_text = '\n'.join(content)
-
-        # Clean up excessive whitespace
-        full_text = re.sub(r'\n\s*\n', '\n\n', full_text)
-        trimmed = full_text.strip()
-
-        document.set_trimmed(trimmed)
+        links, trimmed = extractor.extract_document(document)
+
         document.set_status('TRIMMED')
 
         print(trimmed)
         return trimmed;
-    #ChatGPTed html to markdown for tables.
-    def convert_table_to_markdown(self, table):
-        markdown = []
-        headers = []
-        rows = []
-
-        # Extract table headers
-        header_row = table.find('tr')
-        if not header_row:
-            return ""
-
-        th_tags = header_row.find_all('th')
-        if th_tags:
-            headers = [th.get_text(strip=True) for th in th_tags]
-            rows = table.find_all('tr')[1:]  # Exclude header row
-        else:
-            # If there are no <th>, treat first row as headers
-            td_tags = header_row.find_all('td')
-            headers = [td.get_text(strip=True) for td in td_tags]
-            rows = table.find_all('tr')[1:]
-
-        if not headers:
-            return ""
-
-        # Create Markdown header
-        header_md = '| ' + ' | '.join(headers) + ' |'
-        separator_md = '| ' + ' | '.join(['---'] * len(headers)) + ' |'
-        markdown.append(header_md)
-        markdown.append(separator_md)
-
-        # Add table rows
-        for row in rows:
-            cells = row.find_all(['td', 'th'])
-            row_data = [cell.get_text(strip=True) for cell in cells]
-            row_md = '| ' + ' | '.join(row_data) + ' |'
-            markdown.append(row_md)
-
-        # Combine all parts
-        return '\n'.join(markdown)
 
     #chunk data by headers - create small, medium and large chunksizes
+    #Every chunk is a run of units - a heading paragraph, or the body paragraphs between two headings - so each
+    #unit is in its h1, h2 and h3 chunk. The layout of units is saved with the raw chunks for prettify.
+    #With chunk_max_tokens set, each paragraph is a unit (split further if it's too long on its own) and
+    #sections over the budget are cut between units, see fit_to_budget.
     def chunk(self, document):
         print("CHUNKING")
+        max_tokens = self.project_settings.get('chunk_max_tokens', 0)
+        overlap_tokens = self.project_settings.get('chunk_overlap_tokens', 50)
         trimmed = document.get_trimmed()
         paragraphs = re.split(r'\n\s*\n+', trimmed.strip())
+        if max_tokens:
+            #Leave room for the heading fit_to_budget repeats in front of a section's later parts
+            headings = [tokenizer.count_tokens(p) for p in paragraphs if p.startswith('h1:') or p.startswith('h2:') or p.startswith('h3:')]
+            paragraph_tokens = max(max_tokens // 2, max_tokens - max(headings, default=0))
+            paragraphs = [piece for p in paragraphs for piece in tokenizer.split_text(p, paragraph_tokens, overlap_tokens)]
 
+        units = []
         sections = {'h1': [], 'h2': [], 'h3': []}
 
         for p in paragraphs:
             p.join('\n')
+            heading = p.startswith('h1:') or p.startswith('h2:') or p.startswith('h3:')
+            #A body paragraph following another joins its unit, which is already in every section it belongs to
+            if not heading and units and not units[-1]['heading'] and not max_tokens:
+                units[-1]['paragraphs'].append(p)
+                continue
+            units.append({'heading': heading, 'paragraphs': [p]})
+            u = len(units) - 1
             if p.startswith('h1:'):
-                sections['h1'].append([p])
+                sections['h1'].append([u])
                 sections['h2'].append([])
                 sections['h3'].append([])
             elif p.startswith('h2:'):
-                sections['h1'][-1].append(p)
-                sections['h2'].append([p])
+                sections['h1'][-1].append(u)
+                sections['h2'].append([u])
                 sections['h3'].append([])
             elif p.startswith('h3:'):
-                sections['h1'][-1].append(p)
-                sections['h2'][-1].append(p)
-                sections['h3'].append([p])
+                sections['h1'][-1].append(u)
+                sections['h2'][-1].append(u)
+                sections['h3'].append([u])
             else:
-                sections['h1'][-1].append(p)
-                sections['h2'][-1].append(p)
-                sections['h3'][-1].append(p)
+                sections['h1'][-1].append(u)
+                sections['h2'][-1].append(u)
+                sections['h3'][-1].append(u)
+
+        #Token counts are kept in the layout so later stages can size their requests
+        layout = {'units': [], 'chunks': {}, 'tokens': {}}
+        for unit in units:
+            text = ''.join(unit['paragraphs'])
+            layout['units'].append({'heading': unit['heading'], 'text': text, 'tokens': tokenizer.count_tokens(text)})
+        counts = [unit['tokens'] for unit in layout['units']]
         chunks = {}
-
         for size in sections.keys():
             sections[size] = [ele for ele in sections[size] if ele != []]
-            for chunk_list in sections[size]:
-                chunk = ''.join(chunk_list)
-                if size in chunks:
-                     chunks[size].append(chunk)
-                else:
-                     chunks[size] = [chunk]
+            if max_tokens:
+                sections[size] = [part for unit_list in sections[size] for part in self.fit_to_budget(unit_list, layout['units'], max_tokens, overlap_tokens)]
+            if sections[size]:
+                layout['chunks'][size] = sections[size]
+                layout['tokens'][size] = [sum(counts[u] for u in unit_list) for unit_list in sections[size]]
+                chunks[size] = [''.join(layout['units'][u]['text'] for u in unit_list) for unit_list in sections[size]]
+        print(f"Chunk tokens: { {size: max(tokens) for size, tokens in layout['tokens'].items()} } largest")
         document.set_raw_chunks(chunks)
+        document.set_chunk_layout(layout)
         document.set_status('CHUNKED')
-        self.prettify_chunks(document)
+
+    #Cut a section's units into chunks of at most max_tokens, consecutive chunks sharing up to overlap_tokens.
+    #Each part after the first repeats the section's heading, so it still says what it's about.
+    def fit_to_budget(self, unit_list, units, max_tokens, overlap_tokens):
+        counts = [units[u]['tokens'] for u in unit_list]
+        if sum(counts) <= max_tokens:
+            return [unit_list]
+        heading = []
+        if units[unit_list[0]]['heading'] and len(unit_list) > 1:
+            heading, unit_list, counts = unit_list[:1], unit_list[1:], counts[1:]
+        budget = max(1, max_tokens - sum(units[u]['tokens'] for u in heading))
+        return [heading + [unit_list[i] for i in group] for group in tokenizer.pack(counts, budget, overlap_tokens)]
 
     #remove typos, ect
     def prettify_chunks(self, document):
+        return asyncio.run(self.prettify_chunks_async(document, self.llm_api))
+
+    #Prettify and evaluate are written once as coroutines. With the blocking llmAPI (prettify_chunks/evaluate)
+    #each call simply runs in turn; with AsyncLLMAPI (process_async) the independent calls are all in flight at once.
+    async def call(self, method, *args):
+        result = method(*args)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+    #Embedding and store reads/writes block - in the executor, so the loop keeps serving every document's LLM calls
+    async def blocking(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+    #Like asyncio.gather, but every call runs to the end even when some are waiting on a batch,
+    #so a batch round records all the requests that can be made now
+    async def gather(self, *coroutines):
+        results = await asyncio.gather(*coroutines, return_exceptions=True)
+        pending = None
+        for result in results:
+            if isinstance(result, BatchPending):
+                pending = result
+            elif isinstance(result, BaseException):
+                raise result
+        if pending is not None:
+            raise pending
+        return results
+
+    #Each body unit is prettified once and the pretty chunks are put together from the results, instead of
+    #sending every paragraph again in its h1, h2 and h3 chunk. Headings are kept as they are.
+    async def prettify_chunks_async(self, document, api):
         print("PRETTIFY")
+        layout = await self.blocking(document.get_chunk_layout)
+        if layout is None:
+            #Chunked before layouts were saved
+            await self.blocking(self.chunk, document)
+            layout = await self.blocking(document.get_chunk_layout)
+        units = layout['units']
+        bodies = list(dict.fromkeys(unit['text'] for unit in units if not unit['heading']))
+        prettified = dict(zip(bodies, await self.gather(*[self.call(api.prettify, body) for body in bodies])))
+        pretty_units = [unit['text'] if unit['heading'] else prettified[unit['text']] for unit in units]
+        print(f"Prettified {len(bodies)} sections for {sum(len(c) for c in layout['chunks'].values())} chunks")
+
         pretty_chunks = {}
-        raw_chunks = document.get_raw_chunks()
-        for size in raw_chunks.keys():
-            print(size)
-            pretty_chunks[size] = []
-            for chunk in raw_chunks[size]:
-                pc = self.llm_api.prettify(chunk)
-                print(pc)
-                pretty_chunks[size].append(pc)
-
-        document.set_pretty_chunks(pretty_chunks)
+        for size, unit_lists in layout['chunks'].items():
+            pretty_chunks[size] = ['\n'.join(pretty_units[u] for u in unit_list) for unit_list in unit_lists]
+
+        def save():
+            document.set_pretty_chunks(pretty_chunks)
+            document.set_status('PRETTIFIED')
+        await self.blocking(save)
         return pretty_chunks
 
     #Generate metadata - create new blocks organized by relevancy to potential user searches.
     #Reterns vectors grouped by type, pointing to the lcation of associated information
     def evaluate(self, document):
+        return asyncio.run(self.evaluate_async(document, self.llm_api))
+
+    async def evaluate_async(self, document, api):
         print("EVALUATE")
         
-        pretty_chunks = document.get_pretty_chunks()
+        pretty_chunks = await self.blocking(document.get_pretty_chunks)
         topics = []
         user_questions = []
         keyword_vectors = []
 
+        #Steps finished by an earlier, interrupted evaluate of this document
+        progress = await self.blocking(document.get_progress)
+        questions_done = progress.get('questions', {})
+        keywords_done = progress.get('keywords', {})
+        scored_done = progress.get('relevance', {})
+        if questions_done or keywords_done or scored_done:
+            print(f"Resuming evaluate: {len(questions_done)} question sets, {len(keywords_done)} keyword sets, {len(scored_done)} relevance calls done")
+
+        #One step of describe - saved as soon as it returns, whether or not the other one succeeds
+        async def step(name, done, method, big_chunk):
+            key = self.text_hash(big_chunk)
+            if key not in done:
+                done[key] = list(await self.call(method, big_chunk))
+                await self.blocking(document.save_progress, name, key, done[key])
+            return done[key]
+
         #Extract Metadata from Big Chunk
+        async def describe(big_chunk):
+            return await self.gather(step('questions', questions_done, api.generate_potential_questions_structured, big_chunk),
+                                     step('keywords', keywords_done, api.generate_keywords, big_chunk))
+        described = await self.gather(*[describe(big_chunk) for big_chunk in pretty_chunks['h1']])
+
         for i in range(0, len(pretty_chunks['h1'])):
-            print(i)
             big_chunk = pretty_chunks['h1'][i]
             topic = big_chunk.split('\n')[0]
             if topic.startswith('h1:'):
                 topic = topic[3:].strip()
             topics.append(topic)
 
-            qs = self.llm_api.generate_potential_questions(big_chunk)
+            qs, keywords = described[i]
             user_questions.extend(qs)
 
-            keywords = self.llm_api.generate_keywords(big_chunk)
-
             for kw in keywords:
                 keyword_vectors.append({'keyword': kw, 'filepath': document.doc_id + '/chunks/pretty/h1/' + f'{i}.txt'})
 
@@ -215,8 +340,6 @@ class Refiner():
         for i in range(0, len(topics)):
             topic_vectors.append({'topic': topics[i], 'filepath': document.doc_id + '/chunks/pretty/h1/' + f'{i}.txt'})
 
-        synthetic_chunks = []
-
         relevancy_threshold = 8
 
         to_evaluate = []
@@ -227,15 +350,17 @@ class Refiner():
         if 'h1' in pretty_chunks:
             to_evaluate.extend(pretty_chunks['h1'])
 
-        counter = len(user_questions) * len(to_evaluate)
+        candidates = await self.blocking(self.shortlist, user_questions, to_evaluate)
+
+        scores = await self.score_relevance(api, user_questions, candidates, document, scored_done)
 
-        for q in user_questions:
-            print(f"Countdown counter: {counter}")
+        #A question takes its chunks in order up to the first good enough one
+        def synthesize(i):
+            q = user_questions[i]
             relevant_chunks = []
 
-            for chunk in to_evaluate:
-                relevancy_score = self.llm_api.evaluate_relevance(q, chunk)
-                counter-=1
+            for chunk in candidates[i]:
+                relevancy_score = scores[(i, chunk)]
                 if relevancy_score > 0:
                     relevant_chunks.append((chunk, relevancy_score))
                 if relevancy_score >= relevancy_threshold:
@@ -250,9 +375,11 @@ class Refiner():
                     synthetic_chunk += chunk[0]
                     total_score += chunk[1]
 
-            synthetic_chunks.append({'question': q, 'text' : synthetic_chunk})
+            return {'question': q, 'text' : synthetic_chunk}
 
-        document.save_synthetic_chunks(synthetic_chunks)
+        synthetic_chunks = [synthesize(i) for i in range(len(user_questions))]
+
+        await self.blocking(document.save_synthetic_chunks, synthetic_chunks)
 
 
         question_vectors = []
@@ -261,18 +388,13 @@ class Refiner():
             question_vectors.append({'question':user_questions[i], 'filepath': document.doc_id + f'/chunks/synthetic/{i}.json'})
 
 
-        document.set_status('PROCESSED')
         to_index = {'topics': topic_vectors, 'keywords': keyword_vectors, 'questions': question_vectors}
+        def save():
+            document.set_vectors(to_index)
+            document.update_meta(processed_hash=self.text_hash(document.get_trimmed()))
+            #Cleared first - a crash before PROCESSED just evaluates again, rather than leaving progress behind
+            document.clear_progress()
+            document.set_status('PROCESSED')
+        await self.blocking(save)
         print(f"TO_INDEX:{to_index}")
         return to_index
-
-
-
-
-
-
-
-
-
-
-
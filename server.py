@@ -0,0 +1,137 @@
+#server.py
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from knowledge_base import KnowledgeBase
+from vector_database import VectorDB
+
+#Query server - keeps one loaded KnowledgeBase resident and answers over local HTTP
+#  POST /search       {"query": "..."}
+#  POST /search_many  {"queries": ["...", ...]}
+#  POST /answer       {"query": "..."}
+#  GET  /status
+class KnowledgeBaseServer:
+    def __init__(self, project_settings, host='127.0.0.1', port=8765, reload_interval=5):
+        self.project_settings = project_settings
+        self.project_name = project_settings['project_name']
+        self.host = host
+        self.port = port
+        self.reload_interval = reload_interval
+        self.kb = KnowledgeBase(project_settings)
+        self.kb.index.load(read_only=True)
+        self.index_version = self.kb.index.version()
+        self.loaded_at = time.time()
+        self.reloads = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    #Poll the index files and swap in a freshly loaded index when a background update changed them.
+    #Requests in flight keep the index they started with.
+    def watch(self):
+        while not self.stopped.wait(self.reload_interval):
+            try:
+                version = self.kb.index.version()
+                if version != self.index_version:
+                    self.reload(version)
+            except Exception as e:
+                print(f"Reload failed, keeping current index: {e}")
+
+    def reload(self, version):
+        print("Index changed, reloading")
+        index = VectorDB(self.project_name, self.project_settings)
+        index.load(read_only=True)
+        index.query_cache = self.kb.index.query_cache
+        with self.lock:
+            self.kb.index = index
+            self.index_version = version
+            self.loaded_at = time.time()
+            self.reloads += 1
+        print("Reload complete")
+
+    def status(self):
+        index = self.kb.index
+        return {
+            'project_name': self.project_name,
+            'loaded_at': self.loaded_at,
+            'reloads': self.reloads,
+            'requests': self.requests,
+            'vectors': {'topics': index.topic_db.size, 'questions': index.question_db.size, 'keywords': index.keyword_db.size},
+            'query_cache': {'hits': index.query_cache.hits, 'misses': index.query_cache.misses}
+        }
+
+    def handle(self, path, body):
+        with self.lock:
+            self.requests += 1
+        match path:
+            case '/search':
+                return self.kb.search(body['query'])
+            case '/search_many':
+                results = self.kb.search_many(body['queries'])
+                #Only the slots that found a row - the rest are padded with None and an infinite distance
+                response = {}
+                for search_type, result in results.items():
+                    found = result['indices'] >= 0
+                    response[search_type] = {'file_paths': [file_paths[hits].tolist() for file_paths, hits in zip(result['file_paths'], found)],
+                                             'distances': [distances[hits].tolist() for distances, hits in zip(result['distances'], found)]}
+                return response
+            case '/answer':
+                return {'answer': self.kb.answer(body['query'])}
+            case '/status':
+                return self.status()
+        raise KeyError(path)
+
+    def serve(self):
+        server = ThreadingHTTPServer((self.host, self.port), RequestHandler)
+        server.daemon_threads = True
+        server.kb_server = self
+        watcher = threading.Thread(target=self.watch, daemon=True)
+        watcher.start()
+        print(f"Serving {self.project_name} on http://{self.host}:{self.port}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print("Shutting down")
+        finally:
+            self.stopped.set()
+            server.server_close()
+
+#numpy scalars/arrays and anything else json can't encode
+def to_json(value):
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return str(value)
+
+class RequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.respond(self.path, {})
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError as e:
+            self.send_json(400, {'error': f"Invalid JSON: {e}"})
+            return
+        self.respond(self.path, body)
+
+    def respond(self, path, body):
+        try:
+            result = self.server.kb_server.handle(path, body)
+            self.send_json(200, result)
+        except KeyError as e:
+            self.send_json(404 if str(e).strip("'") == path else 400, {'error': f"Missing or unknown: {e}"})
+        except Exception as e:
+            print(e)
+            self.send_json(500, {'error': str(e)})
+
+    def send_json(self, code, payload):
+        #NaN/Infinity aren't valid JSON - fail loudly rather than send something strict clients can't parse
+        data = json.dumps(payload, default=to_json, allow_nan=False).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
@@ -0,0 +1,114 @@
+#tokenizer.py
+import re
+import math
+
+#tiktoken counts exactly what the OpenAI models see - use it when installed, otherwise estimate
+#about four characters per token, which is close for English text
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+_encoding = None
+
+def get_encoding():
+    global _encoding, tiktoken
+    if _encoding is None and tiktoken is not None:
+        try:
+            _encoding = tiktoken.get_encoding('cl100k_base')
+        except Exception as e:
+            #The encoding is downloaded on first use - estimate instead if that fails
+            print(f"tiktoken unavailable, estimating token counts: {e}")
+            tiktoken = None
+    return _encoding
+
+def count_tokens(text):
+    encoding = get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return math.ceil(len(text) / 4)
+
+#Greedy packing of consecutive pieces into groups of at most max_tokens. Each group after the first starts
+#with the trailing pieces of the one before, up to overlap_tokens of them. A piece larger than max_tokens
+#is a group on its own. Returns lists of piece indices.
+def pack(counts, max_tokens, overlap_tokens=0):
+    groups = []
+    group = []
+    total = 0
+    for i in range(len(counts)):
+        if group and total + counts[i] > max_tokens:
+            groups.append(group)
+            #Carry the tail over, as long as it leaves room for piece i
+            carried = []
+            carried_total = 0
+            for j in reversed(group):
+                if carried_total + counts[j] > overlap_tokens or carried_total + counts[j] + counts[i] > max_tokens:
+                    break
+                carried.insert(0, j)
+                carried_total += counts[j]
+            #Only overlap if the carried tail isn't the whole group, otherwise nothing advances
+            if len(carried) == len(group):
+                carried = []
+                carried_total = 0
+            group = carried
+            total = carried_total
+        group.append(i)
+        total += counts[i]
+    if group:
+        groups.append(group)
+    return groups
+
+#Character offsets in text where a piece may be cut so that it stays within max_tokens. With tiktoken
+#these are token starts; estimating, any character (four to a token).
+def cut_points(text):
+    encoding = get_encoding()
+    if encoding is not None:
+        return encoding.decode_with_offsets(encoding.encode(text))[1], 1
+    return list(range(len(text))), 4
+
+#Cut text with no usable sentence break into pieces of at most max_tokens, between words when there is
+#a space in the second half of the window, otherwise at the token boundary
+def cut(text, max_tokens):
+    offsets, per_token = cut_points(text)
+    window = max(1, max_tokens * per_token)
+    pieces = []
+    start = 0
+    while start < len(offsets):
+        end = start + window
+        if end >= len(offsets) and count_tokens(text[offsets[start]:]) <= max_tokens:
+            pieces.append(text[offsets[start]:])
+            break
+        end = min(end, len(offsets) - 1)
+        for j in range(end, start + window // 2, -1):
+            if text[offsets[j]].isspace():
+                end = j
+                break
+        #Never inside a character (tiktoken tokens are bytes), and re-counted, since a piece on its own
+        #can tokenize a little differently than it did inside the whole text
+        while end > start + 1 and (offsets[end - 1] == offsets[end] or count_tokens(text[offsets[start]:offsets[end]].strip()) > max_tokens):
+            end -= 1
+        if offsets[end] == offsets[start]:
+            #The budget is smaller than one character - take the character anyway
+            while end < len(offsets) and offsets[end] == offsets[start]:
+                end += 1
+            if end >= len(offsets):
+                pieces.append(text[offsets[start]:])
+                break
+        pieces.append(text[offsets[start]:offsets[end]])
+        start = end
+    return [piece.strip() for piece in pieces if piece.strip()]
+
+#Split text into pieces of at most max_tokens - at sentence ends where possible
+def split_text(text, max_tokens, overlap_tokens=0):
+    if count_tokens(text) <= max_tokens:
+        return [text]
+    pieces = []
+    for sentence in re.split(r'(?<=[.!?])\s+', text):
+        if count_tokens(sentence) <= max_tokens:
+            pieces.append(sentence)
+        else:
+            pieces.extend(cut(sentence, max_tokens))
+    #Counted with and without the space that joins them - whichever is more - so the counts add up to
+    #about the joined text's without going under it
+    counts = [max(count_tokens(piece), count_tokens(' ' + piece)) for piece in pieces]
+    return [' '.join(pieces[i] for i in group) for group in pack(counts, max_tokens, overlap_tokens)]
@@ -4,68 +4,125 @@ import hashlib
 
 #Use vectors to map metadata to filepath
 class VectorDB:
-    def __init__(self, project_name):
+    def __init__(self, project_name, project_settings=None):
         self.project_name = project_name
+        self.project_settings = project_settings or {}
         self.llm_api = llmAPI()
-        self.topic_db = DB()
-        self.question_db = DB()
-        self.keyword_db = DB()
+        model_name = self.project_settings.get('embedding_model', DEFAULT_MODEL)
+        batch_size = self.project_settings.get('embedding_batch_size', 64)
+        #All three share one model instance through the registry below
+        ann_settings = self.project_settings.get('ann')
+        self.topic_db = DB(model_name, batch_size=batch_size, ann_settings=ann_settings)
+        self.question_db = DB(model_name, batch_size=batch_size, ann_settings=ann_settings)
+        self.keyword_db = DB(model_name, batch_size=batch_size, ann_settings=ann_settings)
+        self.query_cache = QueryCache(self.project_settings.get('query_cache_size', 1024))
 
-    def load(self):
-        self.topic_db.load_from_json(os.path.join(self.project_name, 'index/topics.json'))
+    def load(self, read_only=False):
+        self.topic_db.load(os.path.join(self.project_name, 'index/topics'), read_only)
+        self.question_db.load(os.path.join(self.project_name, 'index/questions'), read_only)
+        self.keyword_db.load(os.path.join(self.project_name, 'index/keywords'), read_only)
+
+    #Changes whenever a checkpoint or compaction touches the index files - cheap enough to poll
+    def version(self):
+        index_path = os.path.join(self.project_name, 'index')
+        if not os.path.exists(index_path):
+            return None
+        version = []
+        with os.scandir(index_path) as entries:
+            for entry in entries:
+                if entry.is_file() and not entry.name.endswith('.tmp'):
+                    stat = entry.stat()
+                    version.append((entry.name, stat.st_mtime_ns, stat.st_size))
+        return tuple(sorted(version))
+
+    #Rebuild the search structures from the stored rows, e.g. after changing the ann settings
+    def build_index(self):
         self.topic_db.build_index()
-        self.question_db.load_from_json(os.path.join(self.project_name, 'index/questions.json'))
         self.question_db.build_index()
-        self.keyword_db.load_from_json(os.path.join(self.project_name, 'index/keywords.json'))
         self.keyword_db.build_index()
 
-    def save(self):
+    def recall_report(self, k=10, sample=200):
+        return {'topics': self.topic_db.recall_report(k, sample),
+                'questions': self.question_db.recall_report(k, sample),
+                'keywords': self.keyword_db.recall_report(k, sample)}
+
+    #Checkpoint - only appends what changed since the last save unless compact=True
+    def save(self, compact=False):
         os.makedirs(os.path.join(self.project_name, 'index'), exist_ok=True)
-        self.topic_db.save_to_json(os.path.join(self.project_name, 'index/topics.json'))
-        self.question_db.save_to_json(os.path.join(self.project_name, 'index/questions.json'))
-        self.keyword_db.save_to_json(os.path.join(self.project_name, 'index/keywords.json'))
+        self.topic_db.save(os.path.join(self.project_name, 'index/topics'), compact)
+        self.question_db.save(os.path.join(self.project_name, 'index/questions'), compact)
+        self.keyword_db.save(os.path.join(self.project_name, 'index/keywords'), compact)
 
+    #Embed each metadata type in batches - new rows are searchable immediately, no refit.
+    #A document that is indexed again replaces its old rows.
     def index(self, to_index):
-        topic_vectors = []
-        if 'topics' in to_index:
-            topic_vectors = to_index['topics']
+        doc_ids = set()
+        for vectors in to_index.values():
+            doc_ids.update(v['filepath'].split('/')[0] for v in vectors)
+        for doc_id in doc_ids:
+            self.remove_document(doc_id)
+
+        topic_vectors = to_index.get('topics', [])
         if len(topic_vectors) > 0:
-            for v in topic_vectors:
-                #emb = self.llm_api.get_embedding(v['topic'])
-                self.topic_db.add_vector(self.id_from_str(v['filepath']), v['filepath'], v['topic'])
-            
-            self.topic_db.build_index(n_neighbors=3, metric='cosine')
+            self.add_vectors(self.topic_db, topic_vectors, 'topic')
 
-        keyword_vectors = []
-        if 'keywords' in to_index:
-            keyword_vectors = to_index['keywords']
-        if len(keyword_vectors) > 0:
-            for v in keyword_vectors:
-                #emb = self.llm_api.get_embedding(v['keyword'])
-                
-                self.keyword_db.add_vector(self.id_from_str(v['filepath']), v['filepath'], v['keyword'])
-            self.keyword_db.build_index(n_neighbors=8, metric='cosine')
-
-        question_vectors = []
-        if 'questions' in to_index:
-            question_vectors = to_index['questions']
+        keyword_vectors = to_index.get('keywords', [])
         if len(keyword_vectors) > 0:
-            for v in question_vectors:
-                #emb = self.llm_api.get_embedding(v['keyword'])
-                self.question_db.add_vector(self.id_from_str(v['filepath']), v['filepath'], v['question'])
-            self.question_db.build_index(n_neighbors=3, metric='cosine')
+            self.add_vectors(self.keyword_db, keyword_vectors, 'keyword')
+
+        question_vectors = to_index.get('questions', [])
+        if len(question_vectors) > 0:
+            self.add_vectors(self.question_db, question_vectors, 'question')
 
+    def remove_document(self, doc_id):
+        self.topic_db.remove_doc(doc_id)
+        self.question_db.remove_doc(doc_id)
+        self.keyword_db.remove_doc(doc_id)
 
-    def search(self, search_type, query, k):
+    def add_vectors(self, db, vectors, text_key):
+        file_paths = [v['filepath'] for v in vectors]
+        ids = [self.id_from_str(fp) for fp in file_paths]
+        texts = [v[text_key] for v in vectors]
+        db.add_vectors(ids, file_paths, texts)
+
+    def get_db(self, search_type):
         match search_type:
             case 'topics':
-                db = self.topic_db
+                return self.topic_db
             case 'keywords':
-                db = self.keyword_db
+                return self.keyword_db
             case 'questions':
-                db = self.question_db
-        return db.query_kNN(query, k)
+                return self.question_db
+        raise ValueError(f"Unknown search type: {search_type}")
+
+    #Embed a query once - cached, and shared by all three sub-indexes since they use the same model
+    def embed_query(self, query):
+        vector = self.query_cache.get(query)
+        if vector is None:
+            vector = self.topic_db.embed([query])[0]
+            self.query_cache.put(query, vector)
+        return vector
+
+    def search(self, search_type, query, k, query_vector=None):
+        if query_vector is None:
+            query_vector = self.embed_query(query)
+        return self.get_db(search_type).query_by_vector(query_vector, k)
+
+    #Embed many queries - cached ones are reused, the rest go through the model in one batch
+    def embed_queries(self, queries):
+        if len(queries) == 0:
+            return np.empty((0, self.topic_db.dimension()), dtype=np.float32)
+        vectors = [self.query_cache.get(q) for q in queries]
+        missing = [i for i, v in enumerate(vectors) if v is None]
+        if len(missing) > 0:
+            embeddings = self.topic_db.embed([queries[i] for i in missing])
+            for i, embedding in zip(missing, embeddings):
+                vectors[i] = embedding
+                self.query_cache.put(queries[i], embedding)
+        return np.array(vectors, dtype=np.float32).reshape(len(queries), -1)
 
+    def search_many(self, search_type, query_vectors, k):
+        return self.get_db(search_type).query_by_vectors(query_vectors, k)
 
 
     def id_from_str(self, text):
@@ -77,66 +134,442 @@ class VectorDB:
 
 
 ##
-from sentence_transformers import SentenceTransformer
-from sklearn.neighbors import NearestNeighbors
 import numpy as np
 import os
 import json
+import threading
+from collections import OrderedDict
+import time
+
+from journal import Journal
+from ann_index import make_index, normalize, ExactIndex
+
+DEFAULT_MODEL = 'all-MiniLM-L6-v2'
+
+#Process-wide model registry - each model is loaded once, on first use, and shared
+_models = {}
+_models_lock = threading.Lock()
+
+def get_model(model_name=DEFAULT_MODEL):
+    model = _models.get(model_name)
+    if model is None:
+        with _models_lock:
+            model = _models.get(model_name)
+            if model is None:
+                from sentence_transformers import SentenceTransformer
+                print(f"Loading embedding model: {model_name}")
+                model = SentenceTransformer(model_name)
+                _models[model_name] = model
+    return model
+
+#Bounded LRU cache of query embeddings - repeated queries skip the transformer entirely
+class QueryCache:
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
 
 class DB:
-    def __init__(self, model_name='all-MiniLM-L6-v2'):
-        self.model = SentenceTransformer(model_name)
+    def __init__(self, model_name=DEFAULT_MODEL, batch_size=64, ann_settings=None):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        #Search backend - exact brute force unless an approximate one is configured
+        self.ann_settings = ann_settings
+        self.ann = make_index(ann_settings)
         self.ids = []
         self.file_paths = []
-        self.vectors = []
-        self.index = None
+        #Preallocated, growable matrix of unit-length float32 rows - only the first self.size rows are live
+        self.buffer = np.zeros((0, 0), dtype=np.float32)
+        self.size = 0
+        self.lookup = None
+        #Rows of replaced documents - skipped by search, dropped at the next compaction
+        self.deleted_rows = set()
+        self.pending_deletes = []
+        self.rows_by_doc = {}
+        self.rows_by_doc_count = 0
+        #Persistence state - snapshot generation, rows in the snapshot, rows in snapshot + WAL
+        self.generation = None
+        self.saved_count = 0
+        self.logged_count = 0
+
+    #Loaded lazily so commands that never encode don't pay for the model
+    @property
+    def model(self):
+        return get_model(self.model_name)
+
+    @property
+    def vectors(self):
+        return self.buffer[:self.size]
+
+    #Adopt a matrix as-is (e.g. a read-only mmap); it is copied into a writable buffer on the first append
+    @vectors.setter
+    def vectors(self, matrix):
+        self.buffer = matrix
+        self.size = len(matrix)
 
     def add_vector(self, id, file_path, text):
-        print(f"ADDING VECTOR: {file_path}")
-        embedding = self.model.encode(text)
-        self.ids.append(id)
-        self.file_paths.append(file_path)
-        self.vectors.append(embedding)
+        self.add_vectors([id], [file_path], [text])
 
-    def build_index(self, n_neighbors=5, metric='cosine'):
+    #Encode all texts in batches of batch_size instead of one forward pass per string
+    def add_vectors(self, ids, file_paths, texts, batch_size=None):
+        if len(texts) == 0:
+            return
+        if not (len(ids) == len(file_paths) == len(texts)):
+            raise ValueError("ids, file_paths and texts must be the same length.")
+        print(f"ADDING {len(texts)} VECTORS: {file_paths[0]}")
+        embeddings = self.embed(texts, batch_size)
+        self.ids.extend(ids)
+        self.file_paths.extend(file_paths)
+        self.append_rows(embeddings)
+
+    #Unit-length float32 embeddings, one row per text
+    def embed(self, texts, batch_size=None):
+        embeddings = self.model.encode(texts, batch_size=batch_size or self.batch_size)
+        return normalize(np.asarray(embeddings, dtype=np.float32).reshape(len(texts), -1))
+
+    #Width of the vectors - the stored rows', or the model's when nothing is stored yet
+    def dimension(self):
+        if self.size > 0:
+            return self.vectors.shape[1]
+        return self.model.get_sentence_embedding_dimension()
+
+    #Amortized O(1) per row - capacity doubles when full, so the index never has to be refit
+    def append_rows(self, rows):
+        if self.size > 0 and self.buffer.shape[1] != rows.shape[1]:
+            raise ValueError(f"Vector dimension {rows.shape[1]} does not match index dimension {self.buffer.shape[1]}.")
+        needed = self.size + len(rows)
+        if needed > len(self.buffer) or not self.buffer.flags.writeable or self.buffer.shape[1] != rows.shape[1]:
+            capacity = max(needed, 2 * len(self.buffer), 1024)
+            grown = np.zeros((capacity, rows.shape[1]), dtype=np.float32)
+            if self.size > 0:
+                grown[:self.size] = self.buffer[:self.size]
+            self.buffer = grown
+        self.buffer[self.size:needed] = rows
+        start = self.size
+        self.size = needed
+        self.ann.add(self.vectors, start)
+
+    #doc_id -> row indices, extended incrementally as rows are added
+    def rows_for_doc(self, doc_id):
+        for row in range(self.rows_by_doc_count, len(self.file_paths)):
+            self.rows_by_doc.setdefault(self.file_paths[row].split('/')[0], []).append(row)
+        self.rows_by_doc_count = len(self.file_paths)
+        return self.rows_by_doc.get(doc_id, [])
+
+    def remove_doc(self, doc_id):
+        rows = [row for row in self.rows_for_doc(doc_id) if row not in self.deleted_rows]
+        if len(rows) > 0:
+            print(f"Removing {len(rows)} old vectors of {doc_id}")
+            self.deleted_rows.update(rows)
+            self.pending_deletes.extend(rows)
+
+    #Full rebuild, on demand or at load time - appends are searchable without it
+    def build_index(self, metric='cosine'):
         print("Building index...")
         try:
-            if self.vectors is None:
+            if metric != 'cosine':
+                raise ValueError(f"Unsupported metric: {metric}")
+            if self.size == 0:
                 raise ValueError("No vectors to index. Add vectors before building the index.")
             
-            # Convert the list of vectors to a 2D NumPy array
-            self.vectors_array = np.array(self.vectors)
-            
-            # Validate the shape of vectors_array
-            if len(self.vectors_array.shape) != 2 or (len(self.vectors_array.shape) > 0 and self.vectors_array.shape[1] == 0):
+            # Validate the shape of vectors
+            if len(self.vectors.shape) != 2 or self.vectors.shape[1] == 0:
                 raise ValueError("Each vector should have at least one feature.")
-            
-            # Initialize and fit the NearestNeighbors model
-            self.index = NearestNeighbors(n_neighbors=n_neighbors, metric=metric)
-            self.index.fit(self.vectors_array)
-            
+
+            self.ann.build(self.vectors)
             print("Index built successfully.")
-        except:
+        except Exception as e:
+            print(e)
             print("build index failed")
 
-
+    #Cosine kNN through the search backend - rows are unit length, so similarity is a dot product
     def query_kNN(self, text, k=5):
-        if self.index is None:
-            raise ValueError("Index not built. Call build_index() after adding vectors.")
+        return self.query_by_vector(self.embed([text])[0], k)
+
+    #Search with a precomputed query embedding, e.g. one shared across sub-indexes
+    def query_by_vector(self, vector, k=5):
+        if self.size == 0:
+            return []
         
-        query_vec = self.model.encode(text).reshape(1, -1)
-        distances, indices = self.index.kneighbors(query_vec, n_neighbors=k)
+        query_vec = normalize(np.asarray(vector, dtype=np.float32).reshape(1, -1))
+        similarities, indices = self.search_rows(query_vec, k)
         
         results = []
-        for dist, idx in zip(distances[0], indices[0]):
+        for sim, idx in zip(similarities[0], indices[0]):
+            if idx < 0:
+                break
             result = {
                 'id': self.ids[idx],
                 'file_path': self.file_paths[idx],
-                'distance': dist
+                'distance': 1.0 - sim
             }
             results.append(result)
         return results
 
+    #Many queries at once - one encode batch and one matrix multiply per block of queries
+    def query_kNN_batch(self, texts, k=5):
+        return self.query_by_vectors(self.embed(texts), k)
+
+    #Results come back as (queries x k) arrays - nearest first, index -1 and file path None past the last hit
+    def query_by_vectors(self, vectors, k=5, block_size=256):
+        query_vecs = np.asarray(vectors, dtype=np.float32)
+        #No queries - every array below comes out shaped (0, k)
+        if len(query_vecs) > 0:
+            query_vecs = normalize(query_vecs.reshape(len(query_vecs), -1))
+        similarities = np.full((len(query_vecs), k), -np.inf, dtype=np.float32)
+        indices = np.full((len(query_vecs), k), -1, dtype=np.int64)
+        if self.size > 0:
+            #Blocks bound the (queries x rows) similarity matrix for large query sets
+            for start in range(0, len(query_vecs), block_size):
+                end = start + block_size
+                similarities[start:end], indices[start:end] = self.search_rows(query_vecs[start:end], k)
+
+        found = indices >= 0
+        lookup_ids, lookup_file_paths = self.lookup_arrays()
+        ids = np.full(indices.shape, None, dtype=object)
+        file_paths = np.full(indices.shape, None, dtype=object)
+        ids[found] = lookup_ids[indices[found]]
+        file_paths[found] = lookup_file_paths[indices[found]]
+        return {'ids': ids, 'file_paths': file_paths, 'distances': np.where(found, 1.0 - similarities, np.inf), 'indices': indices}
+
+    #Backend search that skips deleted rows - over-fetches, then filters. The over-fetch starts at k and
+    #only doubles when a query's results were mostly deleted rows, so it doesn't grow with every replaced
+    #document until the next compaction.
+    def search_rows(self, query_vecs, k):
+        if len(self.deleted_rows) == 0:
+            return self.ann.search(self.vectors, query_vecs, k)
+        deleted = np.fromiter(self.deleted_rows, dtype=np.int64)
+        wanted = min(k, self.size - len(deleted))
+        most = k + len(deleted)
+        fetch = min(2 * k, most)
+        while True:
+            similarities, indices = self.ann.search(self.vectors, query_vecs, fetch)
+            keep = (indices >= 0) & ~np.isin(indices, deleted)
+            #Done once every query has k live rows, or the backend had no more candidates to give it
+            if fetch >= most or ((keep.sum(axis=1) >= wanted) | (indices[:, -1] < 0)).all():
+                break
+            fetch = min(2 * fetch, most)
+        order = np.argsort(~keep, axis=1, kind='stable')[:, :k]
+        indices = np.take_along_axis(np.where(keep, indices, -1), order, axis=1)
+        similarities = np.take_along_axis(np.where(keep, similarities, -np.inf), order, axis=1)
+        return similarities, indices
+
+    #Object arrays of ids/file paths for vectorized lookups - rebuilt only after rows were added
+    def lookup_arrays(self):
+        if self.lookup is None or len(self.lookup[0]) != len(self.ids):
+            self.lookup = (np.array(self.ids, dtype=object), np.array(self.file_paths, dtype=object))
+        return self.lookup
+
+    #Recall@k and per-query latency of the search backend against exact search, using stored rows as queries.
+    #Queries are drawn from live rows only, and each query's own row - a guaranteed hit - is left out of
+    #both result sets.
+    def recall_report(self, k=10, sample=200, seed=0):
+        live = np.setdiff1d(np.arange(self.size), np.fromiter(self.deleted_rows, dtype=np.int64))
+        if len(live) == 0:
+            return None
+        rng = np.random.default_rng(seed)
+        rows = rng.choice(live, size=min(sample, len(live)), replace=False)
+        queries = np.asarray(self.vectors[rows])
+        start = time.perf_counter()
+        _, exact = ExactIndex().search(np.asarray(self.vectors[live]), queries, k + 1)
+        exact = np.where(exact >= 0, live[exact], -1)
+        exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        start = time.perf_counter()
+        _, approx = self.search_rows(queries, k + 1)
+        ann_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        hits = 0
+        total = 0
+        for row, e, a in zip(rows, exact, approx):
+            e = set(e[(e >= 0) & (e != row)][:k].tolist())
+            hits += len(e & set(a[(a >= 0) & (a != row)][:k].tolist()))
+            total += len(e)
+        return {
+            'backend': self.ann.name,
+            'rows': len(live),
+            'queries': len(queries),
+            'k': k,
+            'recall': hits / total if total else 1.0,
+            'exact_ms': exact_ms,
+            'ann_ms': ann_ms
+        }
+
+    def is_dirty(self):
+        return self.generation is None or len(self.ids) > self.logged_count or len(self.pending_deletes) > 0
+
+    #Persist vectors. A checkpoint only appends rows added since the last one to the
+    #write-ahead log; compact=True rewrites the full snapshot and starts a new log.
+    #Compacting an index with no changes since its snapshot, logged or not, writes nothing.
+    def save(self, path, compact=False):
+        if compact and not self.is_dirty() and self.logged_count == self.saved_count and len(self.deleted_rows) == 0:
+            return
+        if compact or self.generation is None:
+            self.save_snapshot(path)
+        elif len(self.ids) > self.logged_count or len(self.pending_deletes) > 0:
+            self.append_wal(path)
+
+    #Binary format - {path}.{generation}.npy holds a contiguous float32 matrix, {path}.meta.json
+    #the ids, file paths and current generation. Replacing meta.json is the commit point.
+    def save_snapshot(self, path):
+        if len(self.deleted_rows) > 0:
+            self.drop_deleted()
+        previous = self.generation if self.generation is not None else self.stored_generation(path)
+        generation = previous + 1
+        meta = {
+            'model_name': self.model_name,
+            'normalized': True,
+            'generation': generation,
+            'ids': self.ids,
+            'file_paths': self.file_paths
+        }
+        vectors_path = f'{path}.{generation}.npy'
+        with open(vectors_path + '.tmp', 'wb') as f:
+            np.save(f, np.ascontiguousarray(self.vectors, dtype=np.float32))
+        os.replace(vectors_path + '.tmp', vectors_path)
+        with open(path + '.meta.json.tmp', 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        self.ann.save(f'{path}.{generation}')
+        os.replace(path + '.meta.json.tmp', path + '.meta.json')
+
+        for old_file in self.generation_files(path, previous):
+            if os.path.exists(old_file):
+                os.remove(old_file)
+        self.generation = generation
+        self.saved_count = len(self.ids)
+        self.logged_count = len(self.ids)
+        print(f"Vector database saved to {vectors_path}")
+
+    #Compaction drops the rows of replaced documents for good
+    def drop_deleted(self):
+        keep = np.ones(self.size, dtype=bool)
+        keep[list(self.deleted_rows)] = False
+        self.ids = [id for id, k in zip(self.ids, keep) if k]
+        self.file_paths = [fp for fp, k in zip(self.file_paths, keep) if k]
+        self.vectors = np.ascontiguousarray(self.vectors[keep], dtype=np.float32)
+        self.deleted_rows = set()
+        self.pending_deletes = []
+        self.rows_by_doc = {}
+        self.rows_by_doc_count = 0
+        self.lookup = None
+        if self.size > 0:
+            self.ann.build(self.vectors)
+
+    #One record per checkpoint - an npy batch in {path}.{generation}.wal and a line of ids/paths in .wal.jsonl
+    def append_wal(self, path):
+        wal_path, wal_meta_path = self.generation_files(path, self.generation)[1:3]
+        start = self.logged_count
+        with open(wal_path, 'ab') as f:
+            np.save(f, np.ascontiguousarray(self.vectors[start:], dtype=np.float32))
+            f.flush()
+            os.fsync(f.fileno())
+        wal_meta = Journal(wal_meta_path)
+        wal_meta.append({'ids': self.ids[start:], 'file_paths': self.file_paths[start:], 'deleted': self.pending_deletes})
+        wal_meta.flush()
+        self.logged_count = len(self.ids)
+        self.pending_deletes = []
+        print(f"Vector database appended {len(self.ids) - start} vectors to {wal_path}")
+
+    #Generation of the snapshot already on disk, so a fresh DB never reuses its file names
+    def stored_generation(self, path):
+        if not os.path.exists(path + '.meta.json'):
+            return 0
+        with open(path + '.meta.json', 'r', encoding='utf-8') as f:
+            return json.load(f).get('generation', 0)
+
+    def generation_files(self, path, generation):
+        return [f'{path}.{generation}.npy', f'{path}.{generation}.wal', f'{path}.{generation}.wal.jsonl'] + self.ann.files(f'{path}.{generation}')
+
+    #Memory-maps the snapshot - no parsing, no per-row allocation - then replays the WAL.
+    #Migrates old {path}.json indexes. read_only=True never writes, so a reader can load
+    #while another process is still appending to the index.
+    def load(self, path, read_only=False):
+        if not os.path.exists(path + '.meta.json') and os.path.exists(path + '.json'):
+            self.load_from_json(path + '.json')
+            if read_only:
+                return
+            print(f"Migrating {path}.json to binary format")
+            self.save_snapshot(path)
+            os.replace(path + '.json', path + '.json.migrated')
+
+        if not os.path.exists(path + '.meta.json'):
+            raise FileNotFoundError(f"No such file: '{path}.meta.json'")
+
+        with open(path + '.meta.json', 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('model_name', self.model_name) != self.model_name:
+            print(f"Warning: {path} was built with {meta['model_name']}, not {self.model_name}")
+
+        self.generation = meta['generation']
+        self.ann = make_index(self.ann_settings)
+        vectors_path, wal_path, wal_meta_path = self.generation_files(path, self.generation)[:3]
+        self.ids = meta.get('ids', [])
+        self.file_paths = meta.get('file_paths', [])
+        self.lookup = None
+        self.deleted_rows = set()
+        self.pending_deletes = []
+        self.rows_by_doc = {}
+        self.rows_by_doc_count = 0
+        if len(self.ids) > 0:
+            self.vectors = np.load(vectors_path, mmap_mode='r')
+        else:
+            #numpy can't mmap a zero-length array
+            self.vectors = np.load(vectors_path)
+        if len(self.vectors) != len(self.ids):
+            raise ValueError(f"Index {path} is inconsistent: {len(self.vectors)} vectors, {len(self.ids)} ids")
+        if not meta.get('normalized', False) and self.size > 0:
+            #Older snapshot - normalize once in memory, the next compaction stores it normalized
+            self.vectors = normalize(np.asarray(self.vectors, dtype=np.float32))
+        self.saved_count = len(self.ids)
+
+        #Crash recovery - a batch counts only once both its vectors and its ids are on disk
+        wal_records = Journal(wal_meta_path).replay(read_only)
+        batches = []
+        torn = False
+        if os.path.exists(wal_path):
+            with open(wal_path, 'rb') as f:
+                while len(batches) < len(wal_records):
+                    try:
+                        batches.append(np.load(f))
+                    except (ValueError, EOFError, OSError):
+                        break
+                torn = f.tell() < os.path.getsize(wal_path)
+        torn = torn or len(batches) != len(wal_records)
+        for record, batch in zip(wal_records, batches):
+            self.ids.extend(record['ids'])
+            self.file_paths.extend(record['file_paths'])
+            self.append_rows(batch)
+            self.deleted_rows.update(record.get('deleted', []))
+        self.logged_count = len(self.ids)
+        #Use the persisted search structure when there is one, otherwise rebuild it now
+        if not self.ann.load(f'{path}.{self.generation}', self.vectors):
+            self.build_index()
+            if not read_only:
+                self.ann.save(f'{path}.{self.generation}')
+        if torn and not read_only:
+            #Torn log - fold what was recovered into a fresh snapshot
+            self.save_snapshot(path)
+        print(f"Vector database loaded from {vectors_path} (+{self.logged_count - self.saved_count} from log)")
+
     def save_to_json(self, file_path):
         data = {
             'ids': self.ids,
@@ -156,6 +589,13 @@ class DB:
         
         self.ids = data.get('ids', [])
         self.file_paths = data.get('file_paths', [])
-        self.vectors = [np.array(vec) for vec in data.get('vectors', [])]
-        self.index = None  # Invalidate the current index
+        vectors = data.get('vectors', [])
+        if len(vectors) > 0:
+            self.vectors = normalize(np.array(vectors, dtype=np.float32))
+        else:
+            self.vectors = np.zeros((0, 0), dtype=np.float32)
+        #The search structure and lookups are rebuilt for the loaded rows
+        self.lookup = None
+        if self.size > 0:
+            self.ann.build(self.vectors)
         print(f"Vector database loaded from {file_path}.")